@@ -13,8 +13,17 @@
 
 from __future__ import print_function, with_statement
 
+import collections
+import fcntl
+import functools
+import hashlib
 import json
+import math
 import os
+import random
+import re
+import sys
+import threading
 import time
 import paho.mqtt.client as mqtt
 import logging
@@ -33,11 +42,61 @@ AUTO_DISCOVERY = os.environ['AUTO_DISCOVERY']
 DEBUG = os.environ['DEBUG']
 EXPIRE_AFTER = os.environ['EXPIRE_AFTER']
 MQTT_RETAIN = os.environ['MQTT_RETAIN']
+MAPPINGS_FILE = os.environ.get('MAPPINGS_FILE', '/data/mappings.json')
+IDENTITY_FILE = os.environ.get('IDENTITY_FILE', '/data/identities.json')
+DISCOVERY_STALE_AFTER = os.environ.get('DISCOVERY_STALE_AFTER', '0')
+DISCOVERY_MODE = os.environ.get('DISCOVERY_MODE', 'entity')
+LEARN_CADENCE = os.environ.get('LEARN_CADENCE', 'false')
+MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID', 'acurite2mqtt_bridge')
+MQTT_RECONNECT_MAX = os.environ.get('MQTT_RECONNECT_MAX', '60')
 # Convert number environment variables to int
 MQTT_PORT = int(MQTT_PORT)
 DISCOVERY_INTERVAL = int(DISCOVERY_INTERVAL)
+DISCOVERY_STALE_AFTER = int(DISCOVERY_STALE_AFTER)
+MQTT_RECONNECT_MAX = int(MQTT_RECONNECT_MAX)
 
 discovery_timeouts = {}
+# Set while the broker connection is up; background publishers wait on it
+mqtt_ready = threading.Event()
+# Published discovery configs and what they were built from, for reloads
+discovery_entries = {}
+# Digest of each retained discovery config and when its device was last seen
+discovery_hashes = {}
+discovery_seen = {}
+# Configs of collided devices' bare-id topics deleted in this run
+displaced_cleared = set()
+next_stale_sweep = 0
+STARTED = time.time()
+
+# How long a discovery GC listens for retained configs, and its default horizon
+GC_SCAN_SECONDS = 5
+GC_DEFAULT_HORIZON = 7 * 24 * 3600
+
+# Mapped fields seen per device, for device-based discovery
+discovered_fields = {}
+
+# Report-rate learning: events closer than REPEAT_WINDOW are repeats of one
+# transmission, and a device expires after missing CADENCE_MISSED reports
+REPEAT_WINDOW = 2
+CADENCE_MIN_SAMPLES = 4
+CADENCE_MISSED = 3
+EXPIRE_AFTER_MIN = 60
+EXPIRE_AFTER_MAX = 86400
+cadences = {}
+# Sent with device-based discovery, which Home Assistant requires to name its source
+DISCOVERY_ORIGIN = {"name": "acurite2mqtt", "support_url": "https://github.com/thejeffreystone/hassio_addons"}
+
+# How often mappings_file is checked for changes, in seconds
+MAPPINGS_POLL_INTERVAL = 10
+NO_OVERRIDES = {}
+
+# Characters sanitize() replaces or drops, applied in a single pass
+SANITIZE_TABLE = str.maketrans({" ": "_", "/": "_", ".": "_", "&": None})
+
+# Derived forms of a model name, memoized since the set of models seen is small
+MODEL_CACHE_SIZE = 256
+ModelForms = collections.namedtuple(
+    "ModelForms", ["name", "display_name", "manufacturer", "model_name", "object_prefix", "topic_segment"])
 
 whitelist_list = WHITELIST.split()
 blocked = []
@@ -102,28 +161,6 @@ mappings = {
             "value_template": "{{ value|float }}"
         }
     },
-    "temperature_1_C": {
-        "device_type": "sensor",
-        "object_suffix": "T1",
-        "config": {
-            "device_class": "temperature",
-            "state_class":"measurement",
-            "name": "Temperature 1",
-            "unit_of_measurement": "°C",
-            "value_template": "{{ value|float }}"
-        }
-    },
-    "temperature_2_C": {
-        "device_type": "sensor",
-        "object_suffix": "T2",
-        "config": {
-            "device_class": "temperature",
-            "state_class":"measurement",
-            "name": "Temperature 2",
-            "unit_of_measurement": "°C",
-            "value_template": "{{ value|float }}"
-        }
-    },
     "temperature_F": {
         "device_type": "sensor",
         "object_suffix": "F",
@@ -568,6 +605,272 @@ mappings = {
     },
 }
 
+# Families of rtl_433 fields that share one mapping, used for fields not
+# listed in mappings. \1, \2... are filled in from the pattern's groups.
+mapping_rules = [
+    {
+        "pattern": r"temperature_(\d+)_C",
+        "device_type": "sensor",
+        "object_suffix": r"T\1",
+        "config": {
+            "device_class": "temperature",
+            "state_class": "measurement",
+            "name": r"Temperature \1",
+            "unit_of_measurement": "°C",
+            "value_template": "{{ value|float }}"
+        }
+    },
+    {
+        "pattern": r"temperature_(\d+)_F",
+        "device_type": "sensor",
+        "object_suffix": r"F\1",
+        "config": {
+            "device_class": "temperature",
+            "state_class": "measurement",
+            "name": r"Temperature \1",
+            "unit_of_measurement": "°F",
+            "value_template": "{{ value|float }}"
+        }
+    },
+    {
+        "pattern": r"humidity_(\d+)",
+        "device_type": "sensor",
+        "object_suffix": r"H\1",
+        "config": {
+            "device_class": "humidity",
+            "state_class": "measurement",
+            "name": r"Humidity \1",
+            "unit_of_measurement": "%",
+            "value_template": "{{ value|float }}"
+        }
+    },
+    {
+        "pattern": r"(\w+)_ug_m3",
+        "device_type": "sensor",
+        "object_suffix": r"\1",
+        "config": {
+            "state_class": "measurement",
+            "name": r"\1",
+            "unit_of_measurement": "µg/m³",
+            "value_template": "{{ value|float }}"
+        }
+    }
+]
+
+
+def expand_rule(rule, match):
+    """Build the mapping for one field name matched by a rule family."""
+    def expand(value):
+        if isinstance(value, str):
+            return match.expand(value) if "\\" in value else value
+        if isinstance(value, dict):
+            return {k: expand(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [expand(v) for v in value]
+        return value
+
+    return {
+        "device_type": rule["device_type"],
+        "object_suffix": expand(rule["object_suffix"]),
+        "config": expand(rule["config"]),
+    }
+
+
+class MappingStore:
+    """Mappings, rule families and per-device overrides currently in effect.
+
+    Built from mappings and mapping_rules above plus whatever mappings_file
+    adds on top. A new store replaces the old one when the file changes, so
+    a store is never modified after it is built.
+    """
+
+    def __init__(self, overrides=None):
+        overrides = overrides or {}
+        self.mappings = dict(mappings)
+        for key, mapping in overrides.get("mappings", {}).items():
+            # Fail on load, not on the first event that uses it
+            mapping["device_type"], mapping["object_suffix"], mapping["config"]
+            self.mappings[key] = mapping
+        self.rules = [(re.compile(rule["pattern"]), rule)
+                      for rule in overrides.get("rules", []) + mapping_rules]
+        self.disabled_keys = set(overrides.get("disabled_keys", []))
+        self.devices = overrides.get("devices", {})
+        # Migration map: "model/id/channel" -> the identity that device's entities use
+        self.identities = overrides.get("identities", {})
+        if len(set(self.identities.values())) < len(self.identities):
+            raise ValueError("identities must give each device a different identity")
+        self.index = {}
+
+    def resolve(self, key):
+        """Return the mapping for an rtl_433 field, or None if it isn't mapped.
+
+        Literal mappings win over rule families, and the first matching rule
+        wins. The answer, including "not mapped", is cached per field name
+        since it doesn't depend on the model.
+        """
+        try:
+            return self.index[key]
+        except KeyError:
+            pass
+        mapping = None
+        if key not in self.disabled_keys:
+            mapping = self.mappings.get(key)
+            if mapping is None:
+                for pattern, rule in self.rules:
+                    match = pattern.fullmatch(key)
+                    if match:
+                        mapping = expand_rule(rule, match)
+                        break
+        self.index[key] = mapping
+        return mapping
+
+    def device(self, model, instance):
+        """Return the overrides for one device, keyed "model/id" as in its MQTT topic."""
+        return self.devices.get("{}/{}".format(model, instance), NO_OVERRIDES)
+
+
+def resolve_mapping(key):
+    """Return the mapping for an rtl_433 field from the current store."""
+    return store.resolve(key)
+
+
+def load_mappings_file(path):
+    """Build a MappingStore from mappings_file, or None if the file is unusable."""
+    try:
+        with open(path, encoding="utf-8") as handle:
+            return MappingStore(json.load(handle))
+    except FileNotFoundError:
+        return MappingStore()
+    except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+        logging.error("Ignoring {}, keeping the current mappings: {!r}".format(path, e))
+        return None
+
+
+# Mappings in effect, replaced as a whole when mappings_file changes
+store = load_mappings_file(MAPPINGS_FILE) or MappingStore()
+
+
+class IdentityIndex:
+    """Persistent map from (model, id, channel) to the identity used in discovery.
+
+    The identity goes into unique_ids, device identifiers and config topics.
+    The first device seen with an id claims the bare id, so entities made
+    before this index existed keep their unique_ids. Any later device with
+    the same id but another model or channel collides with it and gets
+    "<model>_<id>_<channel>" instead. A device keeps its identity for good;
+    identities in mappings_file pin one, e.g. to migrate an existing entity.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.identities = {}
+        self.warned = False
+
+    def identity(self, forms, instance, channel, pinned=None):
+        """Return the identity of a device, claiming one on first sight."""
+        key = "/".join([forms.name, instance, channel])
+        identity = self.identities.get(key)
+        if identity is not None and (pinned is None or pinned == identity):
+            return identity
+        try:
+            with open(self.path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._load()
+                identity = self._claim(key, forms, instance, channel, pinned)
+                self._save()
+        except OSError as e:
+            # Without the file the identities only hold until a restart
+            if not self.warned:
+                logging.warning("Cannot keep device identities in {}: {}".format(self.path, e))
+                self.warned = True
+            identity = self._claim(key, forms, instance, channel, pinned)
+        return identity
+
+    def displaced(self, forms, instance, channel, identity):
+        """Return the object id a device's configs had before its id collided, or None.
+
+        That is "<model>_<id>", unless a device of the same model holds the
+        bare id and so still publishes there.
+        """
+        if identity != "_".join([forms.object_prefix, instance, channel]):
+            return None
+        holders = "/".join([forms.name, instance, ""])
+        if any(key.startswith(holders) and taken == instance for key, taken in self.identities.items()):
+            return None
+        return "_".join([forms.object_prefix, instance])
+
+    def _claim(self, key, forms, instance, channel, pinned):
+        identity = pinned or self.identities.get(key)
+        if identity is None:
+            holder = next((other for other, taken in self.identities.items() if taken == instance), None)
+            if holder is None:
+                identity = instance
+            else:
+                identity = "_".join([forms.object_prefix, instance, channel])
+                logging.warning("Device {} shares id {} with {}, using identity {}".format(key, instance, holder, identity))
+        self.identities[key] = identity
+        return identity
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as handle:
+                self.identities.update(json.load(handle))
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.error("Ignoring unreadable {}: {}".format(self.path, e))
+
+    def _save(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as handle:
+            json.dump(self.identities, handle, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+identities = IdentityIndex(IDENTITY_FILE)
+
+
+def device_identity(forms, instance, channel):
+    """Return the identity of a device under the current mappings."""
+    pinned = store.identities.get("/".join([forms.name, instance, channel]))
+    return identities.identity(forms, instance, channel, pinned)
+
+
+def object_id(forms, instance, channel):
+    """Return the object id of a device's discovery topics."""
+    identity = device_identity(forms, instance, channel)
+    # A bare id keeps the config topics entities had before identities existed
+    if identity.startswith(forms.object_prefix + "_"):
+        return identity
+    return "_".join([forms.object_prefix, identity])
+
+
+def mappings_file_mtime():
+    """Return the modification time of mappings_file, or None if it doesn't exist."""
+    try:
+        return os.stat(MAPPINGS_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def watch_mappings_file(mqttc):
+    """Poll mappings_file and apply changes to it without a restart."""
+    global store
+    last = mappings_file_mtime()
+    while True:
+        time.sleep(MAPPINGS_POLL_INTERVAL)
+        current = mappings_file_mtime()
+        if current == last:
+            continue
+        last = current
+        new_store = load_mappings_file(MAPPINGS_FILE)
+        if new_store is None:
+            continue
+        store = new_store
+        logging.info("Reloaded {}".format(MAPPINGS_FILE))
+        mqtt_ready.wait()
+        republish_changed(mqttc, new_store)
+
 
 def mqtt_connect(client, userdata, flags, rc):
     """Callback for MQTT connects."""
@@ -576,12 +879,48 @@ def mqtt_connect(client, userdata, flags, rc):
     if rc != 0:
         logging.critical("Could not connect. Error: " + str(rc))
     else:
-        client.subscribe("/".join([MQTT_TOPIC, "events"]))
+        # Subscriptions are renewed on every connect, in case the broker lost the session;
+        # QoS 1 lets a resumed session hold events published with QoS 1 while we were away
+        client.subscribe("/".join([MQTT_TOPIC, "events"]), qos=1)
+        # Without our old session the broker may have lost its retained configs too
+        if not flags.get("session present"):
+            discovery_hashes.clear()
+        client.message_callback_add("/".join([MQTT_TOPIC, "discovery", "gc"]), mqtt_gc_request)
+        client.subscribe("/".join([MQTT_TOPIC, "discovery", "gc"]))
+        mqtt_ready.set()
 
 
 def mqtt_disconnect(client, userdata, rc):
     """Callback for MQTT disconnects."""
     logging.critical("MQTT disconnected: " + mqtt.connack_string(rc))
+    mqtt_ready.clear()
+    # Jitter the backoff so clients don't all retry in step after a broker restart
+    client.reconnect_delay_set(min_delay=random.uniform(0.5, 1.5), max_delay=MQTT_RECONNECT_MAX)
+
+
+def request_seconds(payload):
+    """Return a request's payload as whole seconds, 0 if it is empty.
+
+    Raises ValueError for anything but a non-negative integer.
+    """
+    seconds = int(payload or 0)
+    if seconds < 0:
+        raise ValueError("negative duration {}".format(seconds))
+    return seconds
+
+
+def mqtt_gc_request(client, userdata, msg):
+    """Callback for discovery GC requests; the payload is an optional horizon in seconds."""
+    if msg.retain:
+        # A leftover request, not someone asking now
+        return
+    try:
+        horizon = request_seconds(msg.payload) or DISCOVERY_STALE_AFTER or GC_DEFAULT_HORIZON
+    except ValueError:
+        logging.warning("Ignoring discovery GC request with bad horizon {!r}".format(msg.payload))
+        return
+    # Runs in its own thread so the network loop can deliver the retained configs
+    threading.Thread(target=collect_stale_discovery, args=(client, horizon), daemon=True).start()
 
 
 def mqtt_message(client, userdata, msg):
@@ -597,58 +936,329 @@ def mqtt_message(client, userdata, msg):
         return
 
 
+class Cadence:
+    """Streaming estimate of how often a device reports.
+
+    Keeps a smoothed mean and mean deviation of the gaps between reports,
+    updated the way TCP estimates round-trip times, so it costs two floats
+    per device and follows slow drift without storing any history.
+    """
+
+    __slots__ = ("last", "mean", "dev", "samples")
+
+    def __init__(self):
+        self.last = None
+        self.mean = None
+        self.dev = 0.0
+        self.samples = 0
+
+    def repeat_window(self):
+        """Return the gap below which an event is a repeat of the previous report."""
+        if self.mean is None:
+            return REPEAT_WINDOW
+        return min(REPEAT_WINDOW, self.mean / 4)
+
+    def observe(self, now):
+        """Record an event; return False if it is a repeat of the previous report."""
+        if self.last is not None:
+            gap = now - self.last
+            if gap < self.repeat_window():
+                return False
+            if self.mean is None:
+                self.mean = gap
+                self.dev = gap / 2
+            else:
+                error = gap - self.mean
+                self.mean += error / 8
+                self.dev += (abs(error) - self.dev) / 4
+            self.samples += 1
+        self.last = now
+        return True
+
+    def expire_after(self):
+        """Return the learned expire_after in seconds, or None while still learning.
+
+        Rounded up to quarter-octave steps so the discovery config only
+        changes when the cadence really moves.
+        """
+        if self.samples < CADENCE_MIN_SAMPLES:
+            return None
+        seconds = CADENCE_MISSED * (self.mean + 4 * self.dev)
+        seconds = min(max(seconds, EXPIRE_AFTER_MIN), EXPIRE_AFTER_MAX)
+        return int(math.ceil(2 ** (math.ceil(4 * math.log2(seconds)) / 4)))
+
+
 def sanitize(text):
     """Sanitize a name for Graphite/MQTT use."""
-    return (text
-            .replace(" ", "_")
-            .replace("/", "_")
-            .replace(".", "_")
-            .replace("&", ""))
+    return text.translate(SANITIZE_TABLE)
 
 
-def publish_config(mqttc, topic, model, instance, channel, mapping):
-    """Publish Home Assistant auto discovery data."""
-    global discovery_timeouts
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def model_forms(model):
+    """Return the derived forms of a raw rtl_433 model name, computed once per model."""
+    name = sys.intern(sanitize(model))
+    if '-' in name:
+        manufacturer, model_name = name.split("-", 1)
+    else:
+        manufacturer = 'Unknown'
+        model_name = name
+    return ModelForms(name, name.replace("-", " "), manufacturer, model_name,
+                      sys.intern(name.replace("-", "_")), name)
 
+
+def build_config(topic, forms, instance, channel, mapping, overrides):
+    """Return the discovery config for one mapped field of a device."""
     device_type = mapping["device_type"]
-    object_id = "_".join([model.replace("-", "_"), instance])
     object_suffix = mapping["object_suffix"]
 
-    path = "/".join([DISCOVERY_PREFIX, device_type, object_id, object_suffix, "config"])
+    config = mapping["config"].copy()
+    config["state_topic"] = "/".join([MQTT_TOPIC, forms.topic_segment, instance, channel, topic])
+    config["name"] = " ".join([forms.display_name, instance, object_suffix])
+    identity = device_identity(forms, instance, channel)
+    config["unique_id"] = "".join(["rtl433", device_type, identity, object_suffix])
+    config["availability_topic"] = "/".join([MQTT_TOPIC, "status"])
+    config["expire_after"] = EXPIRE_AFTER
+    if LEARN_CADENCE == "true":
+        cadence = cadences.get((forms.name, instance, channel))
+        if cadence is not None and cadence.expire_after() is not None:
+            config["expire_after"] = cadence.expire_after()
+
+    # add Home Assistant device info
+    device = {}
+    device["identifiers"] = identity
+    device["name"] = overrides.get("name", instance)
+    device["model"] = forms.model_name
+    device["manufacturer"] = forms.manufacturer
+    config["device"] = device
+
+    # Per-field overrides from mappings_file (name, icon, units, ...)
+    # deadband only applies where the bridge publishes state itself
+    for option, value in overrides.get("keys", NO_OVERRIDES).get(topic, NO_OVERRIDES).items():
+        if option != "deadband":
+            config[option] = value
+
+    return config
+
+
+def config_path(forms, instance, channel, mapping):
+    """Return the discovery config topic for one mapped field of a device."""
+    return "/".join([DISCOVERY_PREFIX, mapping["device_type"], object_id(forms, instance, channel),
+                     mapping["object_suffix"], "config"])
+
+
+def publish_config(mqttc, topic, forms, instance, channel, mapping, overrides):
+    """Publish Home Assistant auto discovery data."""
+    global discovery_timeouts
+
+    path = config_path(forms, instance, channel, mapping)
 
     # check timeout
     now = time.time()
+    discovery_seen[path] = now
     if path in discovery_timeouts:
         if discovery_timeouts[path] > now:
             return
 
     discovery_timeouts[path] = now + DISCOVERY_INTERVAL
-
-    config = mapping["config"].copy()
-    config["state_topic"] = "/".join([MQTT_TOPIC, model, instance, channel, topic])
-    config["name"] = " ".join([model.replace("-", " "), instance, object_suffix])
-    config["unique_id"] = "".join(["rtl433", device_type, instance, object_suffix])
+    discovery_entries[path] = (topic, forms, instance, channel)
+
+    config = build_config(topic, forms, instance, channel, mapping, overrides)
+
+    clear_displaced_config(mqttc, forms, instance, channel, mapping["device_type"], mapping["object_suffix"])
+    if send_config(mqttc, path, config):
+        logging.debug("Device Config was saved to {} : {}".format(path,json.dumps(config)))
+
+
+def device_path(forms, instance, channel):
+    """Return the device-based discovery topic for a device."""
+    return "/".join([DISCOVERY_PREFIX, "device", object_id(forms, instance, channel), "config"])
+
+
+def device_config(mapping_store, forms, instance, channel):
+    """Return (path, config) for one device-based discovery message, or None if nothing is on.
+
+    Covers every mapped field seen from the device so far, as components
+    keyed by object_suffix, with the device block and availability sent once.
+    """
+    path = device_path(forms, instance, channel)
+    overrides = mapping_store.device(forms.name, instance)
+    components = {}
+    device = None
+    for topic in sorted(discovered_fields.get(path, ())):
+        mapping = mapping_store.resolve(topic)
+        if mapping is None or topic in overrides.get("disabled_keys", ()):
+            continue
+        component = build_config(topic, forms, instance, channel, mapping, overrides)
+        device = component.pop("device")
+        del component["availability_topic"]
+        component["platform"] = mapping["device_type"]
+        components[mapping["object_suffix"]] = component
+    if not components:
+        return None
+
+    config = {}
+    config["device"] = device
+    config["origin"] = DISCOVERY_ORIGIN
+    config["components"] = components
     config["availability_topic"] = "/".join([MQTT_TOPIC, "status"])
-    config["expire_after"] = EXPIRE_AFTER
+    return path, config
 
-    # add Home Assistant device info
 
-     # Check for missing manufacturer info
-    if '-' in model:
-        manufacturer, model = model.split("-", 1)
-    else:
-        manufacturer = 'Unknown'
+def publish_device_config(mqttc, forms, instance, channel, new_fields):
+    """Publish the device-based discovery message for a device.
+
+    Sent at most once per DISCOVERY_INTERVAL, or right away when the device
+    reports a field it hadn't before. Per-entity configs of new fields are
+    deleted first so Home Assistant doesn't see each entity twice after
+    switching discovery_mode.
+    """
+    path = device_path(forms, instance, channel)
+    now = time.time()
+    discovery_seen[path] = now
+    if not new_fields and discovery_timeouts.get(path, 0) > now:
+        return
+
+    discovery_timeouts[path] = now + DISCOVERY_INTERVAL
+    discovery_entries[path] = (None, forms, instance, channel)
+
+    for topic in new_fields:
+        mapping = resolve_mapping(topic)
+        mqttc.publish(config_path(forms, instance, channel, mapping), "", qos=0, retain=True)
+        clear_displaced_config(mqttc, forms, instance, channel, mapping["device_type"], mapping["object_suffix"])
+    clear_displaced_config(mqttc, forms, instance, channel, "device")
+
+    entry = device_config(store, forms, instance, channel)
+    if entry is not None and send_config(mqttc, *entry):
+        logging.debug("Device Config was saved to {}".format(path))
 
-    device = {}
-    device["identifiers"] = instance
-    device["name"] = instance
-    device["model"] = model
-    device["manufacturer"] = manufacturer
-    config["device"] = device
 
-    mqttc.publish(path, json.dumps(config),  qos=0, retain=True)
-    logging.debug("Device Config was saved to {} : {}".format(path,json.dumps(config)))
-           
+def clear_displaced_config(mqttc, forms, instance, channel, device_type, object_suffix=None):
+    """Delete a config the device had under its bare id before the id collided, once per run.
+
+    That retained config still carries the bare id's unique_id and
+    identifiers, so Home Assistant would keep merging the two devices.
+    """
+    displaced = identities.displaced(forms, instance, channel, device_identity(forms, instance, channel))
+    if displaced is None:
+        return
+    path = "/".join([DISCOVERY_PREFIX, device_type, displaced]
+                    + ([object_suffix] if object_suffix else []) + ["config"])
+    if path not in displaced_cleared:
+        displaced_cleared.add(path)
+        mqttc.publish(path, "", qos=0, retain=True)
+
+
+def send_config(mqttc, path, config):
+    """Publish a discovery config unless the broker already holds this exact one."""
+    payload = json.dumps(config)
+    digest = hashlib.blake2b(payload.encode(), digest_size=16).digest()
+    if discovery_hashes.get(path) == digest:
+        return False
+    discovery_hashes[path] = digest
+    mqttc.publish(path, payload,  qos=0, retain=True)
+    return True
+
+
+def remove_config(mqttc, path):
+    """Delete a retained discovery config, which removes the entity from Home Assistant."""
+    mqttc.publish(path, "", qos=0, retain=True)
+    discovery_entries.pop(path, None)
+    discovery_timeouts.pop(path, None)
+    discovery_hashes.pop(path, None)
+    discovery_seen.pop(path, None)
+
+
+def expire_stale_configs(mqttc, now):
+    """Remove the discovery configs of devices not seen for discovery_stale_after seconds."""
+    global next_stale_sweep
+    if DISCOVERY_STALE_AFTER <= 0 or now < next_stale_sweep:
+        return
+    next_stale_sweep = now + min(DISCOVERY_INTERVAL, DISCOVERY_STALE_AFTER)
+
+    stale = [path for path, seen in list(discovery_seen.items()) if now - seen > DISCOVERY_STALE_AFTER]
+    for path in stale:
+        remove_config(mqttc, path)
+    if stale:
+        logging.info("Removed {} discovery config(s) unseen for {}s".format(len(stale), DISCOVERY_STALE_AFTER))
+
+
+def collect_stale_discovery(mqttc, horizon):
+    """Remove retained rtl_433 discovery configs on the broker unseen for horizon seconds.
+
+    Catches configs this run never published, e.g. from devices that vanished
+    before a restart. Only configs with an rtl433 unique_id and a state topic
+    under mqtt_topic are touched.
+    """
+    retained = {}
+
+    def on_config(client, userdata, msg):
+        if msg.retain and msg.payload:
+            retained[msg.topic] = msg.payload
+
+    # Entity configs, and device configs (<prefix>/device/<object_id>/config)
+    patterns = ("/".join([DISCOVERY_PREFIX, "+", "+", "+", "config"]),
+                "/".join([DISCOVERY_PREFIX, "+", "+", "config"]))
+    for pattern in patterns:
+        mqttc.message_callback_add(pattern, on_config)
+    mqttc.subscribe([(pattern, 0) for pattern in patterns])
+    time.sleep(GC_SCAN_SECONDS)
+    mqttc.unsubscribe(list(patterns))
+    for pattern in patterns:
+        mqttc.message_callback_remove(pattern)
+
+    now = time.time()
+    removed = 0
+    for path, payload in list(retained.items()):
+        try:
+            config = json.loads(payload)
+            # Device-based configs carry the ids and topics in their components
+            entities = [config] + list(config.get("components", {}).values())
+            owned = any(str(entity.get("unique_id", "")).startswith("rtl433")
+                        and str(entity.get("state_topic", "")).startswith(MQTT_TOPIC + "/")
+                        for entity in entities)
+        except (ValueError, AttributeError):
+            continue
+        # Configs not seen in this run count from when the bridge started, so a
+        # quiet device keeps its entities for a full horizon after a restart
+        if owned and now - discovery_seen.get(path, STARTED) > horizon:
+            remove_config(mqttc, path)
+            removed += 1
+
+    logging.info("Discovery GC scanned {} retained config(s), removed {} stale".format(len(retained), removed))
+
+
+def config_for(mapping_store, topic, forms, instance, channel):
+    """Return (path, config) for a field under the given store, or None if it is off."""
+    mapping = mapping_store.resolve(topic)
+    overrides = mapping_store.device(forms.name, instance)
+    if mapping is None or topic in overrides.get("disabled_keys", ()):
+        return None
+    return (config_path(forms, instance, channel, mapping),
+            build_config(topic, forms, instance, channel, mapping, overrides))
+
+
+def republish_changed(mqttc, new_store):
+    """Republish only the discovery configs that a mappings_file change affects."""
+    changed = removed = 0
+    for path, entry in list(discovery_entries.items()):
+        seen = discovery_seen.get(path)
+        if entry[0] is None:
+            new = device_config(new_store, *entry[1:])
+        else:
+            new = config_for(new_store, *entry)
+        if new is None or new[0] != path:
+            # Field turned off or moved; drop the old entity from Home Assistant
+            remove_config(mqttc, path)
+            removed += 1
+        if new is not None:
+            discovery_entries[new[0]] = entry
+            discovery_timeouts[new[0]] = time.time() + DISCOVERY_INTERVAL
+            discovery_seen[new[0]] = seen or time.time()
+            if send_config(mqttc, *new):
+                changed += 1
+
+    logging.info("Mappings reload republished {} and removed {} discovery config(s)".format(changed, removed))
+
 
 def bridge_event_to_hass(mqttc, topic, data):
     """Translate some rtl_433 sensor data to Home Assistant auto discovery."""
@@ -656,7 +1266,7 @@ def bridge_event_to_hass(mqttc, topic, data):
     if "model" not in data:
         # not a device event
         return
-    model = sanitize(data["model"])
+    forms = model_forms(data["model"])
 
     if "id" in data:
         instance = str(data["id"])
@@ -681,15 +1291,27 @@ def bridge_event_to_hass(mqttc, topic, data):
         blocked.append('{}'.format(data['id']))
         return
 
+    if LEARN_CADENCE == "true":
+        cadences.setdefault((forms.name, instance, channel), Cadence()).observe(time.time())
+
     if (auto_discovery == True):
         # Let's reduce the noise in the log and hide the duplicate notifications.
         if (device not in rate_limited) or ( (datetime.now() - rate_limited[device]).seconds > 30 ):
             logging.debug('Device: {} - Creating/Updating device config in Home Assistant for Auto discovery.'.format(device))
         rate_limited[device] = datetime.now()
+        expire_stale_configs(mqttc, time.time())
         # detect known attributes
+        overrides = store.device(forms.name, instance)
+        if DISCOVERY_MODE == "device":
+            fields = discovered_fields.setdefault(device_path(forms, instance, channel), set())
+            new_fields = [key for key in data.keys() if key not in fields and resolve_mapping(key) is not None]
+            fields.update(new_fields)
+            publish_device_config(mqttc, forms, instance, channel, new_fields)
+            return
         for key in data.keys():
-            if key in mappings:
-                publish_config(mqttc, key, model, instance, channel, mappings[key])
+            mapping = resolve_mapping(key)
+            if mapping is not None and key not in overrides.get("disabled_keys", ()):
+                publish_config(mqttc, key, forms, instance, channel, mapping, overrides)
               
 
 
@@ -697,16 +1319,20 @@ def rtl_433_bridge():
     """Run a MQTT Home Assistant auto discovery bridge for rtl_433."""
     logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
     
-    mqttc = mqtt.Client()
+    # A fixed client id with a persistent session lets the broker resume it after a reconnect
+    mqttc = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
     mqttc.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     mqttc.on_connect = mqtt_connect
     mqttc.on_disconnect = mqtt_disconnect
     mqttc.on_message = mqtt_message
+    mqttc.reconnect_delay_set(min_delay=1, max_delay=MQTT_RECONNECT_MAX)
 
     mqttc.will_set("/".join([MQTT_TOPIC, "status"]), payload="offline", qos=0, retain=True)
     mqttc.connect_async(MQTT_HOST, MQTT_PORT, 60)
     mqttc.loop_start()
 
+    threading.Thread(target=watch_mappings_file, args=(mqttc,), daemon=True).start()
+
     logging.info('Started')
 
     while True:
@@ -18,12 +18,59 @@ WHITELIST="$(bashio::config 'whitelist')"
 AUTO_DISCOVERY="$(bashio::config 'auto_discovery')"
 DEBUG="$(bashio::config 'debug')"
 EXPIRE_AFTER="$(bashio::config 'expire_after')"
+SPOOL_ENABLE="$(bashio::config 'spool_enable')"
+SPOOL_MAX_BYTES="$(bashio::config 'spool_max_bytes')"
+SPOOL_DRAIN_RATE="$(bashio::config 'spool_drain_rate')"
+FLIGHT_RECORDER_SIZE="$(bashio::config 'flight_recorder_size')"
+SHARD_WORKERS="$(bashio::config 'shard_workers')"
+MAPPINGS_FILE="$(bashio::config 'mappings_file')"
+IDENTITY_FILE="$(bashio::config 'identity_file')"
+REASSOCIATE_WINDOW="$(bashio::config 'reassociate_window')"
+DISCOVERY_STALE_AFTER="$(bashio::config 'discovery_stale_after')"
+DISCOVERY_MODE="$(bashio::config 'discovery_mode')"
+LEARN_CADENCE="$(bashio::config 'learn_cadence')"
+DEVICE_TIMEOUT="$(bashio::config 'device_timeout')"
+FANOUT="$(bashio::config 'fanout')"
+MQTT_CLIENT_ID="$(bashio::config 'mqtt_client_id')"
+MQTT_RECONNECT_MAX="$(bashio::config 'mqtt_reconnect_max')"
+MQTT_PROTOCOL="$(bashio::config 'mqtt_protocol')"
+MQTT_TOPIC_ALIASES="$(bashio::config 'mqtt_topic_aliases')"
+COMPACT_PAYLOADS="$(bashio::config 'compact_payloads')"
+LATENCY_TRACE="$(bashio::config 'latency_trace')"
+PRIORITY_LANES="$(bashio::config 'priority_lanes')"
+SIGNAL_SUMMARY_INTERVAL="$(bashio::config 'signal_summary_interval')"
+PROTOCOL_REPORT_INTERVAL="$(bashio::config 'protocol_report_interval')"
+HOP_FREQUENCIES="$(bashio::config 'hop_frequencies')"
+HOP_PLAN_FILE=/data/hop_plan.json
+TIMESERIES_URL="$(bashio::config 'timeseries_url')"
+TIMESERIES_TOKEN="$(bashio::config 'timeseries_token')"
+TIMESERIES_FLUSH_INTERVAL="$(bashio::config 'timeseries_flush_interval')"
 
 export LANG=C
 
 # Export config for Python script
 export MQTT_HOST MQTT_PORT MQTT_USERNAME MQTT_PASSWORD MQTT_TOPIC DISCOVERY_PREFIX
 export WHITELIST_ENABLE WHITELIST DISCOVERY_INTERVAL AUTO_DISCOVERY DEBUG EXPIRE_AFTER MQTT_RETAIN
+export SPOOL_ENABLE SPOOL_MAX_BYTES SPOOL_DRAIN_RATE FLIGHT_RECORDER_SIZE SHARD_WORKERS MAPPINGS_FILE IDENTITY_FILE DISCOVERY_STALE_AFTER
+export DISCOVERY_MODE REASSOCIATE_WINDOW
+export LEARN_CADENCE DEVICE_TIMEOUT FANOUT MQTT_CLIENT_ID MQTT_RECONNECT_MAX
+export MQTT_PROTOCOL MQTT_TOPIC_ALIASES COMPACT_PAYLOADS LATENCY_TRACE RTL_SDR_SERIAL_NUM PRIORITY_LANES
+export SIGNAL_SUMMARY_INTERVAL TIMESERIES_URL TIMESERIES_TOKEN TIMESERIES_FLUSH_INTERVAL
+# The validated -R list below is exported too, for the protocol advisor
+export PROTOCOL PROTOCOL_REPORT_INTERVAL HOP_FREQUENCIES HOP_PLAN_FILE
+
+# Latency tracing measures from rtl_433's decode time, which then needs sub-second precision
+TIME_FORMAT="time"
+if [ "$LATENCY_TRACE" = "true" ]; then
+    TIME_FORMAT="time:usec"
+fi
+
+# Signal summaries need rtl_433 to report rssi, snr and noise levels, and hop
+# planning the frequency that comes with them
+LEVEL_FLAG=""
+if [ "$SIGNAL_SUMMARY_INTERVAL" -gt 0 ] || [ -n "$HOP_FREQUENCIES" ]; then
+    LEVEL_FLAG="-M level"
+fi
 
 bashio::log.blue "::::::::RTL_433 Robust Multi-Protocol Mode::::::::"
 
@@ -97,9 +144,17 @@ start_rtl_tcp() {
 
 start_rtl_tcp
 
+# Every rtl_433 session writes into this FIFO and one long-lived bridge reads it,
+# so the MQTT connection and its session survive rtl_433 restarts. Holding it
+# open read-write here keeps the bridge from seeing EOF between sessions.
+BRIDGE_FIFO=/tmp/rtl433_bridge
+rm -f "$BRIDGE_FIFO"
+mkfifo "$BRIDGE_FIFO"
+exec 3<>"$BRIDGE_FIFO"
+
 # Start Python MQTT bridge in background
 start_python_bridge() {
-    python3 /scripts/rtl_433_mqtt_hass.py &
+    python3 /scripts/rtl_433_mqtt_hass.py < "$BRIDGE_FIFO" &
     PYTHON_PID=$!
     bashio::log.info "MQTT bridge started (PID: $PYTHON_PID)"
 }
@@ -130,59 +185,36 @@ while true; do
     
     bashio::log.info "📡 Starting detection session #$RESTART_COUNT"
     
+    # Hop with the bridge's latest plan for these frequencies, or equal dwells until it has one
+    if [ -n "$HOP_FREQUENCIES" ]; then
+        HOP_PLAN="$(jq -r --arg frequencies "$HOP_FREQUENCIES" 'select(.frequencies == $frequencies) | .args' "$HOP_PLAN_FILE" 2>/dev/null)"
+        if [ -n "$HOP_PLAN" ]; then
+            FREQUENCY="$HOP_PLAN"
+        else
+            FREQUENCY="$(for f in $HOP_FREQUENCIES; do printf -- '-f %s ' "$f"; done)-H 120"
+        fi
+        bashio::log.info "📊 Hop plan: $FREQUENCY"
+    fi
+    
     # Build rtl_433 command
     RTL_CMD="rtl_433 -d rtl_tcp:127.0.0.1:1234 $FREQUENCY"
     
     # Add protocols if specified
     if [ -n "$PROTOCOL" ] && [ "$PROTOCOL" != "" ]; then
         RTL_CMD="$RTL_CMD $PROTOCOL"
-        bashio::log.debug "Command: $RTL_CMD -C $UNITS -F json -M time -M protocol"
+        bashio::log.debug "Command: $RTL_CMD -C $UNITS -F json -M $TIME_FORMAT -M protocol $LEVEL_FLAG"
     else
-        bashio::log.debug "Command: $RTL_CMD -C $UNITS -F json -M time -M protocol (all protocols)"
+        bashio::log.debug "Command: $RTL_CMD -C $UNITS -F json -M $TIME_FORMAT -M protocol $LEVEL_FLAG (all protocols)"
     fi
     
-    # Create a named pipe for communication
-    PIPE="/tmp/rtl433_pipe_$$"
-    mkfifo "$PIPE" 2>/dev/null || true
-    
-    # Start rtl_433 and redirect to pipe
+    # Feed rtl_433 to the bridge; sessions are capped at an hour
     (
         set +e  # Don't exit on errors
-        $RTL_CMD -C $UNITS -F json -M time -M protocol 2>/dev/null > "$PIPE"
+        timeout 3600 $RTL_CMD -C $UNITS -F json -M $TIME_FORMAT -M protocol $LEVEL_FLAG 2>/dev/null > "$BRIDGE_FIFO"
         echo "RTL_433_EXIT_CODE=$?" > /tmp/rtl433_exit
     ) &
     RTL_PID=$!
-    
-    # Read from pipe and send to Python bridge
-    timeout 3600 cat "$PIPE" | python3 -c "
-import sys
-import json
-import os
-import paho.mqtt.client as mqtt
-
-# Connect to MQTT
-client = mqtt.Client()
-client.username_pw_set('$MQTT_USERNAME', '$MQTT_PASSWORD')
-client.connect('$MQTT_HOST', $MQTT_PORT, 60)
-client.publish('$MQTT_TOPIC/status', 'online', retain=True)
-
-try:
-    for line in sys.stdin:
-        line = line.strip()
-        if line:
-            try:
-                data = json.loads(line)
-                # Publish to events topic
-                client.publish('$MQTT_TOPIC/events', json.dumps(data), retain=False)
-                print(f'Published: {data.get(\"model\", \"unknown\")} {data.get(\"id\", \"\")}')
-            except:
-                pass
-finally:
-    client.disconnect()
-" 2>/dev/null || true
-    
-    # Clean up pipe
-    rm -f "$PIPE" 2>/dev/null || true
+    wait $RTL_PID
     
     # Check exit status
     if [ -f /tmp/rtl433_exit ]; then
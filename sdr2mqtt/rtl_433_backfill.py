@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Offline batch replay of rtl_433 JSON-lines logs.
+
+Builds the (model, id, channel, key) inventory the bridge would see for a
+set of logs, and optionally the compacted last-value state and discovery
+publishes it would make. Logs are read in chunks into columns so the
+mapping key selection and sanitizing run once per column and once per
+distinct model instead of once per line. NumPy and PyArrow are used when
+they are installed; otherwise plain Python lists do the same job.
+
+Examples:
+    rtl_433_backfill.py rtl_433.log.gz --inventory /data/inventory.csv
+    rtl_433_backfill.py day1.log day2.log --spool /data/spool --discovery
+"""
+
+from __future__ import print_function, with_statement
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+
+# The add-on's options, which entry.sh exports for the bridge when it starts it
+OPTIONS_FILE = "/data/options.json"
+# Options whose environment variable isn't just the upper-cased option name
+OPTION_VARIABLES = {"mqtt_user": "MQTT_USERNAME"}
+# What the bridge can't import without, for running outside the add-on
+BRIDGE_DEFAULTS = {
+    "MQTT_HOST": "localhost", "MQTT_PORT": "1883", "MQTT_USERNAME": "", "MQTT_PASSWORD": "",
+    "MQTT_TOPIC": "rtl_433", "DISCOVERY_PREFIX": "homeassistant", "WHITELIST_ENABLE": "false",
+    "WHITELIST": "", "DISCOVERY_INTERVAL": "600", "AUTO_DISCOVERY": "true", "DEBUG": "false",
+    "EXPIRE_AFTER": "0", "MQTT_RETAIN": "true",
+}
+
+
+def export_options(path=OPTIONS_FILE):
+    """Export the add-on's options the way entry.sh does, without overriding the environment.
+
+    The bridge reads its configuration when it is imported, so this runs
+    first. Outside the add-on there is no options file and the variables
+    the bridge requires fall back to its add-on defaults.
+    """
+    try:
+        with open(path, encoding="utf-8") as handle:
+            options = json.load(handle)
+    except (OSError, ValueError):
+        options = {}
+    for name, value in options.items():
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        os.environ.setdefault(OPTION_VARIABLES.get(name, name.upper()), str(value))
+    for name, value in BRIDGE_DEFAULTS.items():
+        os.environ.setdefault(name, value)
+
+
+export_options()
+import rtl_433_mqtt_hass as bridge  # noqa: E402
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+    import pyarrow.json as pa_json
+except ImportError:
+    pa_json = None
+
+# Columns every event contributes besides the mapped keys
+DEVICE_COLUMNS = ("model", "id", "channel")
+
+
+class CollectingClient:
+    """Stand-in MQTT client that records publishes instead of sending them."""
+
+    def __init__(self):
+        self.records = []
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.records.append({"t": topic, "p": payload, "q": qos, "r": retain})
+
+
+def read_chunks(paths, chunk_lines):
+    """Yield lists of raw JSON lines, chunk_lines at a time, across all logs."""
+    chunk = []
+    for path in paths:
+        if path == "-":
+            handle = sys.stdin.buffer
+        elif path.endswith(".gz"):
+            handle = gzip.open(path, "rb")
+        else:
+            handle = open(path, "rb")
+        try:
+            for line in handle:
+                line = line.strip()
+                if line.startswith(b"{"):
+                    chunk.append(line)
+                    if len(chunk) >= chunk_lines:
+                        yield chunk
+                        chunk = []
+        finally:
+            if handle is not sys.stdin.buffer:
+                handle.close()
+    if chunk:
+        yield chunk
+
+
+def columns_from_arrow(lines):
+    """Parse a chunk with PyArrow's JSON reader, or None if it can't.
+
+    Returns (device columns, presence flags per mapped key). Mapped values
+    are not kept; they are re-read from the original line so they match
+    what the bridge would publish.
+    """
+    try:
+        table = pa_json.read_json(io.BytesIO(b"\n".join(lines)))
+    except pyarrow.ArrowInvalid:
+        # Mixed value types for a column (e.g. hex and numeric ids)
+        return None
+    names = set(table.column_names)
+    columns = {name: table.column(name).to_pylist() for name in DEVICE_COLUMNS if name in names}
+    present = {}
+    for name in filter(bridge.resolve_mapping, names):
+        valid = table.column(name).is_valid()
+        present[name] = valid.to_numpy(zero_copy_only=False) if np is not None else valid.to_pylist()
+    return columns, present
+
+
+def columns_from_json(lines):
+    """Parse a chunk line by line into (device columns, presence flags)."""
+    columns = {}
+    present = {}
+    rows = 0
+    for line in lines:
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = {}
+        for name in DEVICE_COLUMNS:
+            if name in data:
+                column = columns.get(name)
+                if column is None:
+                    column = columns[name] = [None] * rows
+                column.append(data[name])
+        for name in filter(bridge.resolve_mapping, data):
+            flags = present.get(name)
+            if flags is None:
+                flags = present[name] = [False] * rows
+            flags.append(data[name] is not None)
+        rows += 1
+        for column in columns.values():
+            if len(column) < rows:
+                column.append(None)
+        for flags in present.values():
+            if len(flags) < rows:
+                flags.append(False)
+    return columns, present
+
+
+def device_keys(columns):
+    """Return one "model<US>id<US>channel" key per row, None for skipped rows.
+
+    Rows are skipped the same way bridge_event_to_hass skips events: no
+    model, or an id of 0/missing. Sanitizing runs once per distinct model.
+    """
+    models = columns.get("model")
+    if models is None:
+        return None
+    rows = len(models)
+    ids = columns.get("id", [None] * rows)
+    channels = columns.get("channel", [None] * rows)
+
+    sanitized = {}
+    for model in set(models):
+        if model is not None:
+            sanitized[model] = bridge.sanitize(model)
+
+    keys = []
+    for model, instance, channel in zip(models, ids, channels):
+        if model is None or instance is None or str(instance) == "0":
+            keys.append(None)
+        else:
+            channel = "A" if channel is None else str(channel)
+            keys.append("\x1f".join((model, sanitized[model], str(instance), channel)))
+    return keys
+
+
+def summarize_key(keys, present):
+    """Return {device: (count, last row)} for rows where the key is present."""
+    if np is not None:
+        keys = np.array(keys, dtype=object)
+        mask = np.not_equal(keys, None) & np.asarray(present, dtype=bool)
+        rows = np.flatnonzero(mask)
+        if not len(rows):
+            return {}
+        selected = keys[rows].astype(str)
+        # Unique over the reversed rows gives each device's last occurrence
+        unique, first_reversed, counts = np.unique(selected[::-1], return_index=True, return_counts=True)
+        last = rows[len(rows) - 1 - first_reversed]
+        return {device: (count, row)
+                for device, row, count in zip(unique.tolist(), last.tolist(), counts.tolist())}
+
+    summary = {}
+    for row, (device, flag) in enumerate(zip(keys, present)):
+        if device is not None and flag:
+            count = summary[device][0] + 1 if device in summary else 1
+            summary[device] = (count, row)
+    return summary
+
+
+def backfill(paths, chunk_lines):
+    """Return {(device, key): [count, last line]} for every mapped key seen."""
+    inventory = {}
+    lines_read = 0
+
+    for lines in read_chunks(paths, chunk_lines):
+        lines_read += len(lines)
+        parsed = columns_from_arrow(lines) if pa_json is not None else None
+        if parsed is None:
+            parsed = columns_from_json(lines)
+        columns, present = parsed
+
+        keys = device_keys(columns)
+        if keys is None:
+            continue
+        for key, flags in present.items():
+            for device, (count, row) in summarize_key(keys, flags).items():
+                entry = inventory.get((device, key))
+                if entry is None:
+                    inventory[(device, key)] = [count, lines[row]]
+                else:
+                    entry[0] += count
+                    entry[1] = lines[row]
+
+        logging.info(f"Backfill read {lines_read} lines, {len(inventory)} device keys so far")
+
+    return inventory
+
+
+def last_value(line, key):
+    """Return the value of key from a raw event line."""
+    return json.loads(line)[key]
+
+
+def write_inventory(inventory, path):
+    """Write the device/key inventory as CSV, or JSON if path ends in .json."""
+    rows = []
+    for (device, key), (count, line) in sorted(inventory.items()):
+        model, sanitized, instance, channel = device.split("\x1f")
+        rows.append({
+            "model": model,
+            "sanitized_model": sanitized,
+            "id": instance,
+            "channel": channel,
+            "key": key,
+            "object_suffix": bridge.resolve_mapping(key)["object_suffix"],
+            "count": count,
+            "last_value": str(last_value(line, key)),
+            "whitelisted": instance in bridge.whitelist_list,
+        })
+
+    handle = sys.stdout if path == "-" else open(path, "w", newline="", encoding="utf-8")
+    try:
+        if path.endswith(".json"):
+            json.dump(rows, handle, indent=2)
+            handle.write("\n")
+        else:
+            writer = csv.DictWriter(handle, fieldnames=list(rows[0]) if rows else ["model"])
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+
+
+def last_value_publishes(inventory, discovery):
+    """Return spool records for the last value of every device key."""
+    client = CollectingClient()
+    for (device, key), (count, line) in sorted(inventory.items()):
+        model, sanitized, instance, channel = device.split("\x1f")
+        if bridge.whitelist_on and instance not in bridge.whitelist_list:
+            continue
+        record = bridge.DeviceRecord(model, instance, channel)
+        if record.key_disabled(key):
+            continue
+        record.claim_identity()
+        client.publish(record.state_topic(key), str(last_value(line, key)), qos=0, retain=True)
+        if discovery:
+            try:
+                bridge.publish_config(client, key, record, bridge.resolve_mapping(key))
+            except KeyError as e:
+                logging.warning(f"No discovery config for {key}, mapping is missing {e}")
+    return client.records
+
+
+def main():
+    """Parse arguments and run the backfill."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("logs", nargs="+", help="rtl_433 JSON-lines logs (.gz ok, - for stdin)")
+    parser.add_argument("--chunk-lines", type=int, default=100000, help="lines per columnar chunk")
+    parser.add_argument("--inventory", default="-", help="inventory output, .csv or .json (default stdout)")
+    parser.add_argument("--spool", nargs="?", const=bridge.BACKFILL_DIR,
+                        help=f"write last-value publishes for the bridge to replay on its next start "
+                             f"into this directory (default {bridge.BACKFILL_DIR})")
+    parser.add_argument("--discovery", action="store_true", help="also spool discovery configs")
+    args = parser.parse_args()
+
+    inventory = backfill(args.logs, args.chunk_lines)
+    write_inventory(inventory, args.inventory)
+
+    if args.spool:
+        if os.path.realpath(args.spool) == os.path.realpath(bridge.SPOOL_DIR):
+            # The running bridge owns that spool and picks its segments up only on start
+            sys.exit(f"Not writing into the bridge's own spool {bridge.SPOOL_DIR}, use {bridge.BACKFILL_DIR}")
+        # Claims go into the bridge's own identity index, so the live bridge keeps the topics spooled here
+        records = last_value_publishes(inventory, args.discovery)
+        bridge.OfflineSpool(args.spool, bridge.SPOOL_MAX_BYTES, bridge.SPOOL_DRAIN_RATE).extend(records)
+        logging.info(f"Spooled {len(records)} publishes to {args.spool}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Dump or replay the bridge's flight recorder.
+
+The bridge keeps the last raw rtl_433 events it received, with their
+ingest times, in a ring file (flight_recorder_size). This prints them as
+JSON lines, oldest first, or runs them through the bridge offline at their
+recorded times and prints what it would publish.
+
+Examples:
+    rtl_433_flight_recorder.py dump /data/flight_recorder.bin --times
+    rtl_433_flight_recorder.py replay /data/flight_recorder.bin --last 200
+"""
+
+from __future__ import print_function, with_statement
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Imported first: it exports the add-on's options the bridge reads on import
+from rtl_433_backfill import CollectingClient
+import rtl_433_mqtt_hass as bridge
+
+
+class ReplayClock:
+    """Stand-in for the bridge's time module that reads the recorded ingest times."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@contextlib.contextmanager
+def scratch_identities():
+    """Point the bridge at a throwaway copy of its identity index.
+
+    Devices replayed here claim identities in the copy, so the running
+    bridge's identities.json is never written from here.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        copy = os.path.join(directory, "identities.json")
+        if os.path.exists(bridge.IDENTITY_FILE):
+            shutil.copyfile(bridge.IDENTITY_FILE, copy)
+        live, bridge.identities = bridge.identities, bridge.IdentityIndex(copy)
+        try:
+            yield
+        finally:
+            bridge.identities = live
+
+
+def read_events(path, last=None):
+    """Return (ingest time, length, raw bytes) for the recorded events, oldest first.
+
+    The file is read in one go, so a bridge that keeps recording only
+    matters for the oldest slot, which is skipped as it may be mid-write.
+    Events cut short by the recorder have a length above len(raw).
+    """
+    with open(path, "rb") as handle:
+        data = handle.read()
+    magic, version, slot_size, slots, sequence = bridge.FLIGHT_HEADER.unpack_from(data)
+    if magic != bridge.FLIGHT_MAGIC or version != bridge.FLIGHT_VERSION:
+        raise ValueError(f"{path} is not a flight recorder file")
+
+    first = max(sequence - slots + 1, 0)
+    if last is not None:
+        first = max(first, sequence - last)
+    events = []
+    for number in range(first, sequence):
+        offset = bridge.FLIGHT_DATA_OFFSET + (number % slots) * slot_size
+        length, ingested = bridge.FLIGHT_SLOT.unpack_from(data, offset)
+        offset += bridge.FLIGHT_SLOT.size
+        events.append((ingested, length, data[offset:offset + min(length, slot_size - bridge.FLIGHT_SLOT.size)]))
+    return events
+
+
+def dump(events, times):
+    """Print the events as JSON lines, optionally after their ingest time."""
+    for ingested, length, raw in events:
+        line = raw.decode("utf-8", "replace")
+        if length > len(raw):
+            line += f"  # cut short, {length} bytes"
+        if times:
+            line = f"{datetime.fromtimestamp(ingested).isoformat(timespec='microseconds')}\t{line}"
+        print(line)
+
+
+def replay(events):
+    """Run the events through the bridge at their ingest times and print its publishes."""
+    clock = bridge.time = ReplayClock()
+    client = CollectingClient()
+    with scratch_identities():
+        for ingested, length, raw in events:
+            if length > len(raw):
+                continue
+            clock.now = ingested
+            bridge.process_line(client, raw)
+            for record in client.records:
+                if isinstance(record["p"], bytes):
+                    record["p"] = record["p"].decode("utf-8", "replace")
+                print(json.dumps(record))
+            client.records = []
+
+
+def main():
+    """Parse arguments and dump or replay the flight recorder."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=("dump", "replay"))
+    parser.add_argument("path", nargs="?", default=bridge.FLIGHT_RECORDER_FILE, help="flight recorder file")
+    parser.add_argument("--last", type=int, help="only the last N events")
+    parser.add_argument("--times", action="store_true", help="prefix dumped events with their ingest time")
+    args = parser.parse_args()
+
+    try:
+        events = read_events(args.path, args.last)
+    except (OSError, ValueError, bridge.struct.error) as e:
+        sys.exit(f"Cannot read {args.path}: {e}")
+    if args.command == "dump":
+        dump(events, args.times)
+    else:
+        replay(events)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,32 @@
 
 from __future__ import print_function, with_statement
 
+import bisect
+import collections
+import fcntl
+import functools
+import hashlib
+import http.client
 import json
+import math
+import mmap
 import os
+import random
+import re
+import shutil
+import signal
+import socket
+import struct
 import sys
 import time
+import tracemalloc
+import urllib.parse
+import zlib
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import logging
+import multiprocessing
 from datetime import datetime
 import threading
 
@@ -27,16 +47,243 @@ AUTO_DISCOVERY = os.environ['AUTO_DISCOVERY']
 DEBUG = os.environ['DEBUG']
 EXPIRE_AFTER = os.environ['EXPIRE_AFTER']
 MQTT_RETAIN = os.environ['MQTT_RETAIN']
+MAPPINGS_FILE = os.environ.get('MAPPINGS_FILE', '/data/mappings.json')
+IDENTITY_FILE = os.environ.get('IDENTITY_FILE', '/data/identities.json')
+DISCOVERY_STALE_AFTER = os.environ.get('DISCOVERY_STALE_AFTER', '0')
+DISCOVERY_MODE = os.environ.get('DISCOVERY_MODE', 'entity')
+LEARN_CADENCE = os.environ.get('LEARN_CADENCE', 'false')
+DEVICE_TIMEOUT = os.environ.get('DEVICE_TIMEOUT', '0')
+FANOUT = os.environ.get('FANOUT', 'events states device keys')
+MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID', 'rtl433_bridge')
+MQTT_RECONNECT_MAX = os.environ.get('MQTT_RECONNECT_MAX', '60')
+MQTT_PROTOCOL = os.environ.get('MQTT_PROTOCOL', '3.1.1')
+MQTT_TOPIC_ALIASES = os.environ.get('MQTT_TOPIC_ALIASES', '100')
+COMPACT_PAYLOADS = os.environ.get('COMPACT_PAYLOADS', 'false')
+LATENCY_TRACE = os.environ.get('LATENCY_TRACE', 'false')
+PRIORITY_LANES = os.environ.get('PRIORITY_LANES', 'false')
+SIGNAL_SUMMARY_INTERVAL = os.environ.get('SIGNAL_SUMMARY_INTERVAL', '0')
+REASSOCIATE_WINDOW = os.environ.get('REASSOCIATE_WINDOW', '0')
+PROTOCOL = os.environ.get('PROTOCOL', '')
+PROTOCOL_REPORT_INTERVAL = os.environ.get('PROTOCOL_REPORT_INTERVAL', '0')
+PROTOCOL_STATS_FILE = os.environ.get('PROTOCOL_STATS_FILE', '/data/protocol_stats.json')
+HOP_FREQUENCIES = os.environ.get('HOP_FREQUENCIES', '')
+HOP_PLAN_FILE = os.environ.get('HOP_PLAN_FILE', '/data/hop_plan.json')
+TIMESERIES_URL = os.environ.get('TIMESERIES_URL', '')
+TIMESERIES_TOKEN = os.environ.get('TIMESERIES_TOKEN', '')
+TIMESERIES_FLUSH_INTERVAL = os.environ.get('TIMESERIES_FLUSH_INTERVAL', '10')
+RTL_SDR_SERIAL_NUM = os.environ.get('RTL_SDR_SERIAL_NUM', '')
+SPOOL_ENABLE = os.environ.get('SPOOL_ENABLE', 'true')
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '/data/spool')
+BACKFILL_DIR = os.environ.get('BACKFILL_DIR', '/data/backfill')
+DIAGNOSTICS_DIR = os.environ.get('DIAGNOSTICS_DIR', '/data')
+SPOOL_MAX_BYTES = os.environ.get('SPOOL_MAX_BYTES', '5242880')
+SPOOL_DRAIN_RATE = os.environ.get('SPOOL_DRAIN_RATE', '20')
+FLIGHT_RECORDER_SIZE = os.environ.get('FLIGHT_RECORDER_SIZE', '1048576')
+FLIGHT_RECORDER_FILE = os.environ.get('FLIGHT_RECORDER_FILE', '/data/flight_recorder.bin')
+SHARD_WORKERS = os.environ.get('SHARD_WORKERS', '0')
 
 # Convert number environment variables to int
 MQTT_PORT = int(MQTT_PORT)
 DISCOVERY_INTERVAL = int(DISCOVERY_INTERVAL)
+SPOOL_MAX_BYTES = int(SPOOL_MAX_BYTES)
+SPOOL_DRAIN_RATE = float(SPOOL_DRAIN_RATE)
+FLIGHT_RECORDER_SIZE = int(FLIGHT_RECORDER_SIZE)
+SHARD_WORKERS = int(SHARD_WORKERS)
+DISCOVERY_STALE_AFTER = int(DISCOVERY_STALE_AFTER)
+DEVICE_TIMEOUT = int(DEVICE_TIMEOUT)
+MQTT_RECONNECT_MAX = int(MQTT_RECONNECT_MAX)
+MQTT_TOPIC_ALIASES = int(MQTT_TOPIC_ALIASES)
+SIGNAL_SUMMARY_INTERVAL = int(SIGNAL_SUMMARY_INTERVAL)
+REASSOCIATE_WINDOW = int(REASSOCIATE_WINDOW)
+PROTOCOL_REPORT_INTERVAL = int(PROTOCOL_REPORT_INTERVAL)
+TIMESERIES_FLUSH_INTERVAL = float(TIMESERIES_FLUSH_INTERVAL)
 
 discovery_timeouts = {}
+# Published discovery configs and what they were built from, for reloads
+discovery_entries = {}
+# Digest of each retained discovery config and when its device was last seen
+discovery_hashes = {}
+discovery_seen = {}
+# Configs of collided devices' bare-id topics deleted in this run
+displaced_cleared = set()
+next_stale_sweep = 0
+STARTED = time.time()
+next_signal_summary = STARTED + SIGNAL_SUMMARY_INTERVAL
 whitelist_list = WHITELIST.split()
-blocked = []
+blocked = set()
 rate_limited = {}
 
+# Known devices, keyed on the raw (model, id, channel) of their events, least recently heard first
+DEVICE_TABLE_SIZE = 1024
+device_table = collections.OrderedDict()
+
+# Report-rate learning: events closer than REPEAT_WINDOW are repeats of one
+# transmission, and a device expires after missing CADENCE_MISSED reports
+REPEAT_WINDOW = 2
+CADENCE_MIN_SAMPLES = 4
+CADENCE_MISSED = 3
+EXPIRE_AFTER_MIN = 60
+EXPIRE_AFTER_MAX = 86400
+
+# Battery-swap re-association: a vanished device must have missed REASSOCIATE_SILENCE
+# report periods, and its measurements must be within REASSOCIATE_TOLERANCE (relative,
+# at least 1) and its RSSI within REASSOCIATE_RSSI_DB of the new id's first report
+REASSOCIATE_SILENCE = 1.5
+REASSOCIATE_TOLERANCE = 0.1
+REASSOCIATE_RSSI_DB = 6
+
+# Protocol advisor: decodes a protocol needs to be recommended, and the width in MHz
+# of the frequency buckets decodes are tallied in
+PROTOCOL_TOPIC = f"{MQTT_TOPIC}/protocols"
+PROTOCOL_MIN_DECODES = 3
+PROTOCOL_FREQ_BUCKET = 0.05
+
+# Frequency hopping: dwell limits in seconds (a band whose devices' periods aren't
+# known yet gets HOP_LEARN_DWELL to learn them), the dwell margin over the longest
+# period, how far in MHz a decode may be from its hop frequency, how often the plan
+# is redone, and after how long an unheard device stops counting
+HOP_TOPIC = f"{MQTT_TOPIC}/hop_plan"
+HOP_MIN_DWELL = 30
+HOP_LEARN_DWELL = 120
+HOP_MAX_DWELL = 600
+HOP_DWELL_MARGIN = 1.25
+HOP_BAND_WIDTH = 3
+HOP_PLAN_INTERVAL = 600
+HOP_FORGET_AFTER = 86400
+
+# Per-device liveness: a timing wheel of LIVENESS_SLOTS buckets, LIVENESS_TICK seconds each
+LIVENESS_TICK = 5
+LIVENESS_SLOTS = 720
+
+STATUS_TOPIC = f"{MQTT_TOPIC}/status"
+EVENTS_TOPIC = f"{MQTT_TOPIC}/events"
+STATES_TOPIC = f"{MQTT_TOPIC}/states"
+GC_TOPIC = f"{MQTT_TOPIC}/discovery/gc"
+SIGNAL_TOPIC = f"{MQTT_TOPIC}/signal"
+SIGNAL_RAW_TOPIC = f"{MQTT_TOPIC}/signal/raw"
+
+# Outputs an event can feed, and the ones the fanout option turns on
+FANOUT_OUTPUTS = ("status", "events", "states", "device", "keys")
+fanout = frozenset(FANOUT.replace(",", " ").split())
+
+# Sent with device-based discovery, which Home Assistant requires to name its source
+DISCOVERY_ORIGIN = {"name": "sdr2mqtt", "support_url": "https://github.com/galbers/hassio_addons"}
+# Options every component of a device shares, sent once per device in device mode
+SHARED_OPTIONS = ("availability_topic", "payload_available", "payload_not_available",
+                  "availability", "availability_mode")
+
+# MQTT 5 session lifetime on the broker, standing in for MQTT 3's clean_session=False
+MQTT_SESSION_EXPIRY = 24 * 3600
+# A topic alias costs a PUBLISH property of 1 byte id and 2 bytes value
+TOPIC_ALIAS_OVERHEAD = 3
+# Compact JSON drops the space json.dumps puts after each separator
+JSON_SEPARATORS = (",", ":") if COMPACT_PAYLOADS == "true" else None
+SAVINGS_REPORT_INTERVAL = 60
+
+# Latency tracing: histogram bucket bounds in seconds, how often a summary is
+# logged and published, and how many events may wait for a publish ack
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30)
+LATENCY_REPORT_INTERVAL = 60
+LATENCY_PENDING_MAX = 1000
+LATENCY_TOPIC = f"{MQTT_TOPIC}/metrics/latency"
+
+# How long a discovery GC listens for retained configs, and its default horizon
+GC_SCAN_SECONDS = 5
+
+# On-demand diagnostics: default and longest runs in seconds, the profiler's sampling
+# interval, and the stack depth and report length of allocation traces
+DIAGNOSTICS_TOPIC = f"{MQTT_TOPIC}/diagnostics/+"
+PROFILE_DEFAULT = 60
+PROFILE_MAX = 600
+PROFILE_INTERVAL = 0.01
+MEMORY_DEFAULT = 3600
+MEMORY_MAX = 7 * 86400
+MEMORY_FRAMES = 10
+MEMORY_TOP = 50
+
+# Flight recorder file: a header of magic, version, slot size, slot count and the
+# sequence number of the next event, then slots of event length, ingest time and raw bytes
+FLIGHT_MAGIC = b"RTL433FR"
+FLIGHT_VERSION = 1
+FLIGHT_HEADER = struct.Struct("<8sIIQQ")
+FLIGHT_SEQUENCE = struct.Struct("<Q")
+FLIGHT_SEQUENCE_OFFSET = 24
+FLIGHT_DATA_OFFSET = 64
+FLIGHT_SLOT = struct.Struct("<Id")
+FLIGHT_SLOT_SIZE = 1024
+GC_DEFAULT_HORIZON = 7 * 24 * 3600
+
+# How often mappings_file is checked for changes, in seconds
+MAPPINGS_POLL_INTERVAL = 10
+NO_OVERRIDES = {}
+
+# Publish lanes for field states. Alarm states go out ahead of the rest of their
+# event with QoS 1; diagnostic ones are coalesced per topic and flushed in the
+# background, the oldest shed first when DIAGNOSTIC_LANE_SIZE topics are waiting
+Lane = collections.namedtuple("Lane", ["qos", "retain", "deferred"])
+PUBLISH_LANES = {
+    "alarm": Lane(1, True, False),
+    "normal": Lane(0, True, False),
+    "diagnostic": Lane(0, True, True),
+}
+ALARM_KEYS = ("alarm", "tamper", "strike_count", "storm_dist")
+ALARM_DEVICE_CLASSES = ("safety", "tamper", "smoke", "gas", "carbon_monoxide", "moisture", "problem")
+DIAGNOSTIC_LANE_SIZE = 500
+DIAGNOSTIC_FLUSH_INTERVAL = 5
+
+# Signal summaries: the per-packet level fields they replace, EWMA weight,
+# histogram bucket width in dB, and how long a raw request lasts by default and at most
+SIGNAL_KEYS = ("rssi", "snr", "noise")
+# Fields repeats of one transmission differ in: its time, and what -M level adds
+REPEAT_IGNORED_KEYS = frozenset(("time",) + SIGNAL_KEYS + ("freq", "freq1", "freq2"))
+SIGNAL_EWMA_ALPHA = 0.1
+SIGNAL_BUCKET_DB = 0.5
+SIGNAL_RAW_DEFAULT = 300
+SIGNAL_RAW_MAX = 3600
+# Per-device summary entity; its state topic carries the JSON summary as attributes too
+SIGNAL_SUMMARY_KEY = "signal_summary"
+SIGNAL_MAPPING = {
+    "device_type": "sensor",
+    "object_suffix": "signal",
+    "attributes": True,
+    "config": {
+        "device_class": "signal_strength",
+        "state_class": "measurement",
+        "unit_of_measurement": "dB",
+        "entity_category": "diagnostic",
+        "name": "Signal",
+        "value_template": "{{ value_json.rssi.ewma if 'rssi' in value_json else none }}"
+    }
+}
+
+# Time-series sink: measurement (InfluxDB) or path prefix (Graphite), lines per
+# write, lines buffered while the endpoint is slow or down, and the largest UDP datagram
+TIMESERIES_MEASUREMENT = "rtl_433"
+TIMESERIES_BATCH_SIZE = 500
+TIMESERIES_BUFFER_MAX = 20000
+TIMESERIES_UDP_MAX = 1400
+TIMESERIES_TIMEOUT = 10
+TIMESERIES_SCHEMES = ("influx", "influx+https", "influx+udp", "graphite")
+# Characters InfluxDB line protocol needs escaped in tag keys and values
+INFLUX_TAG_TABLE = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ "})
+
+# What a windowed field publishes, and the digits a window's mean is rounded to
+AGGREGATE_FUNCTIONS = ("mean", "min", "max", "last")
+AGGREGATE_DIGITS = 3
+
+# Characters sanitize() replaces or drops, applied in a single pass
+SANITIZE_TABLE = str.maketrans({" ": "_", "/": "_", ".": "_", "&": None, "-": "_"})
+
+# Derived forms of a model name; sdr2mqtt uses the sanitized name for ids and topics
+MODEL_CACHE_SIZE = 256
+ModelForms = collections.namedtuple(
+    "ModelForms", ["name", "display_name", "manufacturer", "model_name", "object_prefix", "topic_segment"])
+
+# Sharded mode: lines are routed to workers by (model, id) without a full JSON parse
+SHARD_QUEUE_SIZE = 1000
+SHARD_MODEL = re.compile(rb'"model"\s*:\s*"([^"]*)"')
+SHARD_ID = re.compile(rb'"id"\s*:\s*("[^"]*"|[-0-9]+)')
+
 if DEBUG == "true":
     LOGLEVEL = os.environ.get('LOGLEVEL', 'DEBUG').upper()
 else:
@@ -48,8 +295,36 @@ auto_discovery = (AUTO_DISCOVERY == "true")
 # Configure logging
 logging.basicConfig(format='%(levelname)s:%(message)s', level=LOGLEVEL)
 
+for output in sorted(fanout.difference(FANOUT_OUTPUTS)):
+    logging.warning(f"Ignoring unknown fanout output {output!r}")
+
 # Global MQTT client for availability updates
 mqtt_client = None
+# Set while the broker connection is up; publishes wait on it when there is no spool
+mqtt_ready = threading.Event()
+
+# Disk-backed spool for publishes made while the broker is unreachable
+spool = None
+
+# Ring of the last raw events, unless flight_recorder_size is 0
+recorder = None
+
+# MQTT 5 topic aliases and the bytes they and compact payloads save, when enabled
+topic_aliases = None
+savings = None
+
+# Time-series output when timeseries_url is set
+timeseries = None
+
+# Decode tally per protocol when protocol_report_interval is set
+advisor = None
+
+# Hop plan scheduler when hop_frequencies is set
+scheduler = None
+
+# Latency histograms when latency_trace is on, and the event each thread is bridging
+tracer = None
+tracing = threading.local()
 
 mappings = {
     "time": {
@@ -162,26 +437,1049 @@ mappings = {
     }
 }
 
+# Families of rtl_433 fields that share one mapping, used for fields not
+# listed in mappings. \1, \2... are filled in from the pattern's groups.
+mapping_rules = [
+    {
+        "pattern": r"temperature_(\d+)_C",
+        "device_type": "sensor",
+        "object_suffix": r"T\1",
+        "config": {
+            "device_class": "temperature",
+            "state_class": "measurement",
+            "name": r"Temperature \1",
+            "unit_of_measurement": "°C",
+            "value_template": "{{ value|float }}"
+        }
+    },
+    {
+        "pattern": r"temperature_(\d+)_F",
+        "device_type": "sensor",
+        "object_suffix": r"F\1",
+        "config": {
+            "device_class": "temperature",
+            "state_class": "measurement",
+            "name": r"Temperature \1",
+            "unit_of_measurement": "°F",
+            "value_template": "{{ value|float }}"
+        }
+    },
+    {
+        "pattern": r"humidity_(\d+)",
+        "device_type": "sensor",
+        "object_suffix": r"H\1",
+        "config": {
+            "device_class": "humidity",
+            "state_class": "measurement",
+            "name": r"Humidity \1",
+            "unit_of_measurement": "%",
+            "value_template": "{{ value|float }}"
+        }
+    },
+    {
+        "pattern": r"(\w+)_ug_m3",
+        "device_type": "sensor",
+        "object_suffix": r"\1",
+        "config": {
+            "state_class": "measurement",
+            "name": r"\1",
+            "unit_of_measurement": "µg/m³",
+            "value_template": "{{ value|float }}"
+        }
+    }
+]
+
+def expand_rule(rule, match):
+    """Build the mapping for one field name matched by a rule family."""
+    def expand(value):
+        if isinstance(value, str):
+            return match.expand(value) if "\\" in value else value
+        if isinstance(value, dict):
+            return {k: expand(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [expand(v) for v in value]
+        return value
+
+    mapping = {
+        "device_type": rule["device_type"],
+        "object_suffix": expand(rule["object_suffix"]),
+        "config": expand(rule["config"]),
+    }
+    if "lane" in rule:
+        mapping["lane"] = rule["lane"]
+    return mapping
+
+
+def check_aggregate(key, spec):
+    """Raise ValueError if a field's aggregate options from mappings_file are unusable."""
+    if spec.get("function", "mean") not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f"{key}: aggregate function must be one of {', '.join(AGGREGATE_FUNCTIONS)}")
+    if not spec["window"] > 0 or not spec.get("slide", 1) > 0:
+        raise ValueError(f"{key}: aggregate window and slide must be positive")
+
+
+class MappingStore:
+    """Mappings, rule families and per-device overrides currently in effect.
+
+    Built from mappings and mapping_rules above plus whatever mappings_file
+    adds on top. A new store replaces the old one when the file changes, so
+    a store is never modified after it is built.
+    """
+
+    def __init__(self, overrides=None):
+        overrides = overrides or {}
+        self.mappings = dict(mappings)
+        for key, mapping in overrides.get("mappings", {}).items():
+            # Fail on load, not on the first event that uses it
+            mapping["device_type"], mapping["object_suffix"], mapping["config"]
+            self.mappings[key] = mapping
+        self.rules = [(re.compile(rule["pattern"]), rule)
+                      for rule in overrides.get("rules", []) + mapping_rules]
+        for entry in list(self.mappings.values()) + [rule for _, rule in self.rules]:
+            if entry.get("lane", "normal") not in PUBLISH_LANES:
+                raise ValueError(f"Unknown publish lane {entry['lane']!r}, expected one of {', '.join(PUBLISH_LANES)}")
+        self.disabled_keys = set(overrides.get("disabled_keys", []))
+        if SIGNAL_SUMMARY_INTERVAL > 0:
+            # Summarized instead of published per packet
+            self.mappings.setdefault(SIGNAL_SUMMARY_KEY, SIGNAL_MAPPING)
+            self.disabled_keys.update(SIGNAL_KEYS)
+        self.devices = overrides.get("devices", {})
+        # Migration map: "model/id/channel" -> the identity that device's entities use
+        self.identities = overrides.get("identities", {})
+        if len(set(self.identities.values())) < len(self.identities):
+            raise ValueError("identities must give each device a different identity")
+        for key in self.identities:
+            # Devices look their pin up by sanitized model, so anything else is a typo
+            parts = key.rsplit("/", 2)
+            if len(parts) != 3:
+                logging.warning(f"Identity pin {key!r} will never match a device, expected model/id/channel")
+            elif parts[0].translate(SANITIZE_TABLE) != parts[0]:
+                parts[0] = parts[0].translate(SANITIZE_TABLE)
+                logging.warning(f"Identity pin {key!r} will never match a device, "
+                                f"use the model as in its MQTT topic: {'/'.join(parts)!r}")
+        for device in self.devices.values():
+            for key, options in device.get("keys", {}).items():
+                if "aggregate" in options:
+                    check_aggregate(key, options["aggregate"])
+        self.index = {}
+        self.lanes = {}
+
+    def resolve(self, key):
+        """Return the mapping for an rtl_433 field, or None if it isn't mapped.
+
+        Literal mappings win over rule families, and the first matching rule
+        wins. The answer, including "not mapped", is cached per field name
+        since it doesn't depend on the model.
+        """
+        try:
+            return self.index[key]
+        except KeyError:
+            pass
+        mapping = None
+        if key not in self.disabled_keys:
+            mapping = self.mappings.get(key)
+            if mapping is None:
+                for pattern, rule in self.rules:
+                    match = pattern.fullmatch(key)
+                    if match:
+                        mapping = expand_rule(rule, match)
+                        break
+        self.index[key] = mapping
+        return mapping
+
+    def lane(self, key):
+        """Return the publish lane of a field, cached per field name like resolve().
+
+        A lane set on the mapping wins. Otherwise ALARM_KEYS and alarm-type
+        binary sensors are "alarm", diagnostic entities are "diagnostic" and
+        everything else is "normal". Without priority_lanes all are "normal".
+        """
+        try:
+            return self.lanes[key]
+        except KeyError:
+            pass
+        mapping = self.resolve(key)
+        if mapping is None or PRIORITY_LANES != "true":
+            lane = "normal"
+        elif "lane" in mapping:
+            lane = mapping["lane"]
+        elif key in ALARM_KEYS or (mapping["device_type"] == "binary_sensor"
+                                   and mapping["config"].get("device_class") in ALARM_DEVICE_CLASSES):
+            lane = "alarm"
+        elif mapping["config"].get("entity_category") == "diagnostic":
+            lane = "diagnostic"
+        else:
+            lane = "normal"
+        self.lanes[key] = lane
+        return lane
+
+    def device(self, model, instance):
+        """Return the overrides for one device, keyed "model/id" as in its MQTT topic."""
+        return self.devices.get(f"{model}/{instance}", NO_OVERRIDES)
+
+
+def resolve_mapping(key):
+    """Return the mapping for an rtl_433 field from the current store."""
+    return store.resolve(key)
+
+
+def load_mappings_file(path):
+    """Build a MappingStore from mappings_file, or None if the file is unusable."""
+    try:
+        with open(path, encoding="utf-8") as handle:
+            return MappingStore(json.load(handle))
+    except FileNotFoundError:
+        return MappingStore()
+    except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+        logging.error(f"Ignoring {path}, keeping the current mappings: {e!r}")
+        return None
+
+
+# Mappings in effect, replaced as a whole when mappings_file changes
+store = load_mappings_file(MAPPINGS_FILE) or MappingStore()
+
+
+class IdentityIndex:
+    """Persistent map from (model, id, channel) to the identity used in discovery.
+
+    The identity goes into unique_ids, device identifiers and config topics.
+    The first device seen with an id claims the bare id, so entities made
+    before this index existed keep their unique_ids. Any later device with
+    the same id but another model or channel collides with it and gets
+    "<model>_<id>_<channel>" instead. A device keeps its identity for good;
+    identities in mappings_file pin one, e.g. to migrate an existing entity.
+    Claims are written to identity_file under a lock, so shard workers agree.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.identities = {}
+        # Devices that claimed an identity in this run, never seen before
+        self.new = set()
+        self.warned = False
+        self.loaded = False
+
+    def identity(self, forms, instance, channel, pinned=None):
+        """Return the identity of a device, claiming one on first sight."""
+        key = f"{forms.name}/{instance}/{channel}"
+        identity = self.identities.get(key)
+        if identity is not None and (pinned is None or pinned == identity):
+            return identity
+        return self._update(lambda: self._claim(key, forms, instance, channel, pinned))
+
+    def get(self, key):
+        """Return the identity of a "model/id/channel" key, or None; never claims one."""
+        if not self.loaded:
+            self._load()
+        return self.identities.get(key)
+
+    def devices(self):
+        """Return the "model/id/channel" keys of every device in the index."""
+        self._load()
+        return list(self.identities)
+
+    def displaced(self, forms, instance, channel, identity):
+        """Return the object id a device's configs had before its id collided, or None.
+
+        That is "<model>_<id>", unless a device of the same model holds the
+        bare id and so still publishes there.
+        """
+        if identity != f"{forms.object_prefix}_{instance}_{channel}":
+            return None
+        holders = f"{forms.name}/{instance}/"
+        if any(key.startswith(holders) and taken == instance for key, taken in self.identities.items()):
+            return None
+        return f"{forms.object_prefix}_{instance}"
+
+    def transfer(self, forms, instance, new_instance, channel, identity):
+        """Hand a device's identity over to the new id it reports with."""
+        old_key = f"{forms.name}/{instance}/{channel}"
+        new_key = f"{forms.name}/{new_instance}/{channel}"
+
+        def move():
+            self.identities.pop(old_key, None)
+            self.identities[new_key] = identity
+            self.new.discard(new_key)
+
+        self._update(move)
+
+    def _update(self, change):
+        """Apply change to the index and the file, under the file's lock."""
+        try:
+            with open(f"{self.path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._load()
+                result = change()
+                self._save()
+        except OSError as e:
+            # Without the file the identities only hold until a restart
+            if not self.warned:
+                logging.warning(f"Cannot keep device identities in {self.path}: {e}")
+                self.warned = True
+            result = change()
+        return result
+
+    def _claim(self, key, forms, instance, channel, pinned):
+        identity = pinned or self.identities.get(key)
+        if identity is None:
+            self.new.add(key)
+            holder = next((other for other, taken in self.identities.items() if taken == instance), None)
+            if holder is None:
+                identity = instance
+            else:
+                identity = f"{forms.object_prefix}_{instance}_{channel}"
+                logging.warning(f"Device {key} shares id {instance} with {holder}, using identity {identity}")
+        self.identities[key] = identity
+        return identity
+
+    def _load(self):
+        self.loaded = True
+        try:
+            with open(self.path, encoding="utf-8") as handle:
+                self.identities.update(json.load(handle))
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.error(f"Ignoring unreadable {self.path}: {e}")
+
+    def _save(self):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as handle:
+            json.dump(self.identities, handle, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+identities = IdentityIndex(IDENTITY_FILE)
+
+
+def mappings_file_mtime():
+    """Return the modification time of mappings_file, or None if it doesn't exist."""
+    try:
+        return os.stat(MAPPINGS_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def watch_mappings_file(mqttc, on_change=None):
+    """Poll mappings_file and apply changes to it without a restart."""
+    global store
+    last = mappings_file_mtime()
+    while True:
+        time.sleep(MAPPINGS_POLL_INTERVAL)
+        current = mappings_file_mtime()
+        if current == last:
+            continue
+        last = current
+        new_store = load_mappings_file(MAPPINGS_FILE)
+        if new_store is None:
+            continue
+        store = new_store
+        logging.info(f"Reloaded {MAPPINGS_FILE}")
+        republish_changed(mqttc, new_store)
+        if on_change is not None:
+            on_change()
+
+
+class OfflineSpool:
+    """Append-only segment log that holds publishes while the broker is down.
+
+    Records are JSON lines of topic, payload, qos and retain. Once the spool
+    grows past max_bytes it is compacted to the last record per topic, and
+    the oldest records are dropped if that is still not enough. On reconnect
+    the backlog is drained at drain_rate messages per second while new
+    publishes go straight out; a retained record whose topic has since been
+    published live is skipped, so the drain never overwrites a newer value.
+    """
+
+    def __init__(self, directory, max_bytes, drain_rate):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(max_bytes // 4, 4096)
+        self.drain_rate = drain_rate
+        self.lock = threading.Lock()
+        self.segments = []
+        self.sizes = {}
+        self.active = None
+        self.draining = False
+        # The segment the drain is reading, left alone by compaction
+        self.draining_path = None
+        # Topics published live since the backlog started draining, newer than
+        # anything spooled for them before; cleared once the spool is empty
+        self.live_topics = set()
+        self.sequence = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("spool-") and name.endswith(".log"):
+                path = os.path.join(directory, name)
+                self.segments.append(path)
+                self.sizes[path] = os.path.getsize(path)
+                self.sequence = max(self.sequence, int(name[6:-4]))
+        if self.segments:
+            logging.info(f"Spool holds {len(self.segments)} segment(s) from a previous run")
+
+    def adopt(self, directory):
+        """Move the segments rtl_433_backfill wrote to directory behind this spool's own."""
+        try:
+            names = sorted(name for name in os.listdir(directory)
+                           if name.startswith("spool-") and name.endswith(".log"))
+        except FileNotFoundError:
+            return
+        with self.lock:
+            for name in names:
+                self.sequence += 1
+                path = os.path.join(self.directory, f"spool-{self.sequence:08d}.log")
+                shutil.move(os.path.join(directory, name), path)
+                self.segments.append(path)
+                self.sizes[path] = os.path.getsize(path)
+        if names:
+            logging.info(f"Spool took over {len(names)} backfilled segment(s) from {directory}")
+
+    def total_bytes(self):
+        """Return the size of all segments on disk."""
+        return sum(self.sizes.values())
+
+    def capture(self, mqttc, topic, payload, qos, retain):
+        """Spool a publish if the broker is down or a backlog is pending but not draining yet."""
+        with self.lock:
+            if mqttc.is_connected() and (self.draining or not self.segments):
+                if self.draining:
+                    self.live_topics.add(topic)
+                return False
+            if isinstance(payload, bytes):
+                payload = payload.decode()
+            self.live_topics.discard(topic)
+            self._append({"t": topic, "p": payload, "q": qos, "r": retain})
+            return True
+
+    def extend(self, records):
+        """Append records produced outside the bridge, such as a backfill."""
+        with self.lock:
+            for record in records:
+                self._append(record)
+            self._roll()
+
+    def _append(self, record):
+        if self.active is None:
+            self.sequence += 1
+            path = os.path.join(self.directory, f"spool-{self.sequence:08d}.log")
+            self.active = open(path, "a", encoding="utf-8")
+            self.segments.append(path)
+            self.sizes[path] = 0
+        line = json.dumps(record) + "\n"
+        self.active.write(line)
+        self.active.flush()
+        self.sizes[self.active.name] += len(line.encode("utf-8"))
+
+        if self.sizes[self.active.name] >= self.segment_bytes:
+            self._roll()
+        if self.total_bytes() > self.max_bytes:
+            self._compact()
+
+    def _roll(self):
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+
+    def _read(self, path):
+        records = []
+        with open(path, encoding="utf-8") as segment:
+            for line in segment:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logging.warning(f"Skipping corrupt spool record in {path}")
+        return records
+
+    def _write(self, path, records):
+        with open(path, "w", encoding="utf-8") as segment:
+            for record in records:
+                segment.write(json.dumps(record) + "\n")
+        self.sizes[path] = os.path.getsize(path)
+
+    def _compact(self):
+        """Collapse the spool to the last record per topic, then enforce the cap."""
+        self._roll()
+        kept = [path for path in self.segments if path == self.draining_path]
+        latest = {}
+        for path in self.segments:
+            if path in kept:
+                continue
+            for record in self._read(path):
+                latest.pop(record["t"], None)
+                latest[record["t"]] = record
+        records = list(latest.values())
+
+        dropped = 0
+        while records and sum(len(json.dumps(r)) + 1 for r in records) > self.max_bytes // 2:
+            records.pop(0)
+            dropped += 1
+
+        for path in self.segments:
+            if path not in kept:
+                os.remove(path)
+                del self.sizes[path]
+        self.segments = kept
+        if records:
+            self.sequence += 1
+            path = os.path.join(self.directory, f"spool-{self.sequence:08d}.log")
+            self._write(path, records)
+            self.segments.append(path)
+
+        if dropped:
+            logging.warning(f"Spool full, compacted to {len(records)} topic(s) and dropped {dropped} oldest record(s)")
+        else:
+            logging.info(f"Spool compacted to {len(records)} topic(s)")
+
+    def start_drain(self, mqttc):
+        """Replay the backlog in a background thread after a reconnect."""
+        with self.lock:
+            if self.draining or not self.segments:
+                return
+            self.draining = True
+        threading.Thread(target=self._drain, args=(mqttc,), daemon=True).start()
+
+    def _drain(self, mqttc):
+        interval = 1.0 / self.drain_rate if self.drain_rate > 0 else 0
+        published = 0
+        while True:
+            with self.lock:
+                if not self.segments:
+                    self.draining = False
+                    self.draining_path = None
+                    self.live_topics.clear()
+                    break
+                path = self.draining_path = self.segments[0]
+                if self.active is not None and self.active.name == path:
+                    self._roll()
+
+            records = self._read(path)
+            for index, record in enumerate(records):
+                if not mqttc.is_connected():
+                    with self.lock:
+                        if path in self.sizes:
+                            self._write(path, records[index:])
+                        self.draining = False
+                        self.draining_path = None
+                    logging.warning(f"Spool drain interrupted after {published} message(s)")
+                    return
+                if record["r"] and record["t"] in self.live_topics:
+                    continue
+                mqttc.publish(record["t"], record["p"], qos=record["q"], retain=record["r"])
+                published += 1
+                if interval:
+                    time.sleep(interval)
+
+            with self.lock:
+                if path in self.sizes:
+                    os.remove(path)
+                    del self.sizes[path]
+                    self.segments.remove(path)
+
+        logging.info(f"Spool drained {published} message(s)")
+
+
+class FlightRecorder:
+    """The last raw events in a memory-mapped ring file, for postmortems.
+
+    Each event takes the next of a fixed number of FLIGHT_SLOT_SIZE slots,
+    with its length and ingest time, so recording one is a copy into the
+    map. The kernel writes the pages back on its own, and they outlive a
+    crash of the bridge. Events longer than a slot are cut short; the slot
+    keeps their full length. rtl_433_flight_recorder.py reads the file.
+    """
+
+    def __init__(self, path, size):
+        self.slots = max((size - FLIGHT_DATA_OFFSET) // FLIGHT_SLOT_SIZE, 1)
+        size = FLIGHT_DATA_OFFSET + self.slots * FLIGHT_SLOT_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.capacity = FLIGHT_SLOT_SIZE - FLIGHT_SLOT.size
+
+        # Carry on after the events of the previous run, unless the layout changed
+        magic, version, slot_size, slots, self.sequence = FLIGHT_HEADER.unpack_from(self.map)
+        if (magic, version, slot_size, slots) != (FLIGHT_MAGIC, FLIGHT_VERSION, FLIGHT_SLOT_SIZE, self.slots):
+            self.sequence = 0
+            FLIGHT_HEADER.pack_into(self.map, 0, FLIGHT_MAGIC, FLIGHT_VERSION, FLIGHT_SLOT_SIZE, self.slots, 0)
+
+    def record(self, line, now):
+        """Put a raw event into the oldest slot."""
+        offset = FLIGHT_DATA_OFFSET + (self.sequence % self.slots) * FLIGHT_SLOT_SIZE
+        FLIGHT_SLOT.pack_into(self.map, offset, len(line), now)
+        if len(line) > self.capacity:
+            line = line[:self.capacity]
+        offset += FLIGHT_SLOT.size
+        self.map[offset:offset + len(line)] = line
+        self.sequence += 1
+        FLIGHT_SEQUENCE.pack_into(self.map, FLIGHT_SEQUENCE_OFFSET, self.sequence)
+
+
+class TopicAliases:
+    """MQTT 5 topic aliases for the most recently published topics.
+
+    The broker grants up to its Topic Alias Maximum per connection. Aliased
+    topics are kept in LRU order and a new topic takes over the slot of the
+    least recently used one. The table starts over on every connect.
+
+    Only QoS 0 publishes made while connected are aliased: paho queues
+    anything else and sends it again as it was after a reconnect, when the
+    alias it carries is no longer known to the broker.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.maximum = 0
+        self.slots = collections.OrderedDict()
+        # Held across the publish so alias assignments reach paho in order
+        self.lock = threading.Lock()
+
+    def reset(self, broker_maximum):
+        """Forget all aliases and use up to broker_maximum slots from now on."""
+        with self.lock:
+            self.maximum = min(self.limit, broker_maximum)
+            self.slots.clear()
+        return self.maximum
+
+    def publish(self, mqttc, topic, payload, qos, retain):
+        """Publish with an alias for topic; returns paho's message info and the bytes saved."""
+        if qos > 0:
+            return mqttc.publish(topic, payload, qos=qos, retain=retain), 0
+        with self.lock:
+            if not mqttc.is_connected():
+                return mqttc.publish(topic, payload, qos=qos, retain=retain), 0
+            alias = self.slots.get(topic)
+            if alias is not None:
+                self.slots.move_to_end(topic)
+                saved = len(topic.encode()) - TOPIC_ALIAS_OVERHEAD
+                topic_sent = ""
+            elif self.maximum:
+                if len(self.slots) < self.maximum:
+                    alias = len(self.slots) + 1
+                else:
+                    alias = self.slots.popitem(last=False)[1]
+                self.slots[topic] = alias
+                saved = -TOPIC_ALIAS_OVERHEAD
+                topic_sent = topic
+            else:
+                return mqttc.publish(topic, payload, qos=qos, retain=retain), 0
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = alias
+            info = mqttc.publish(topic_sent, payload, qos=qos, retain=retain, properties=properties)
+        return info, saved
+
+
+class TransportSavings:
+    """Bytes saved by topic aliases and compact payloads, logged once a minute."""
+
+    def __init__(self):
+        self.aliases = 0
+        self.payloads = 0
+        self.next_report = time.time() + SAVINGS_REPORT_INTERVAL
+        self.lock = threading.Lock()
+
+    def add(self, aliases=0, payloads=0):
+        with self.lock:
+            self.aliases += aliases
+            self.payloads += payloads
+            now = time.time()
+            if now < self.next_report:
+                return
+            logging.info(f"MQTT saved {self.aliases + self.payloads} bytes in the last minute "
+                         f"({self.aliases} by topic aliases, {self.payloads} by compact payloads)")
+            self.aliases = self.payloads = 0
+            self.next_report = now + SAVINGS_REPORT_INTERVAL
+
+
+def dump_json(data):
+    """Serialize data for a payload, compactly if compact_payloads is on."""
+    payload = json.dumps(data, separators=JSON_SEPARATORS)
+    if savings is not None and JSON_SEPARATORS is not None:
+        # Measured against what the default separators would have sent
+        savings.add(payloads=len(json.dumps(data)) - len(payload))
+    return payload
+
+
+def format_value(value):
+    """Return the state payload for a value; compact payloads drop a float's trailing .0."""
+    if JSON_SEPARATORS is not None and type(value) is float and value.is_integer():
+        if savings is not None:
+            savings.add(payloads=2)
+        return str(int(value))
+    return str(value)
+
+
+def decode_time(value):
+    """Return an rtl_433 "time" field as a Unix timestamp, or None if it isn't one."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        # Local time, as rtl_433 writes it with -M time or -M time:usec
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class EventTrace:
+    """Timestamps of one event on its way through the bridge."""
+
+    __slots__ = ("ingested", "decoded", "last", "stages", "model", "info")
+
+    def __init__(self, now):
+        self.ingested = self.last = now
+        self.decoded = None
+        self.stages = {}
+        self.model = None
+        # paho's message info for the event's last publish, if it reached paho
+        self.info = None
+
+    def lap(self, stage):
+        """Charge the time since the previous lap to stage."""
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.last
+        self.last = now
+
+
+class LatencyHistogram:
+    """Counts of latencies in LATENCY_BUCKETS, plus one bucket for anything slower."""
+
+    __slots__ = ("counts", "total", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the q quantile, in seconds."""
+        rank = q * sum(self.counts)
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        count = sum(self.counts)
+        return {
+            "count": count,
+            "mean_ms": round(1000 * self.total / count, 3) if count else 0,
+            "p50_ms": round(1000 * self.quantile(0.5), 3),
+            "p95_ms": round(1000 * self.quantile(0.95), 3),
+            "p99_ms": round(1000 * self.quantile(0.99), 3),
+            "max_ms": round(1000 * self.maximum, 3),
+            "counts": self.counts,
+        }
+
+
+class LatencyTracer:
+    """Per-stage latency histograms for the receiver as a whole and for each model.
+
+    Stages are pipe (rtl_433 decode time to the bridge reading the line),
+    parse, dedup (lookup, whitelist and repeat check), mapping (fanout and
+    state publishes), discovery, and ack (until paho's on_publish for the
+    event's last publish). bridge covers ingest to ack and total covers
+    decode to ack. Histograms accumulate from startup.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.histograms = {}
+        # Events whose last publish paho hasn't sent yet, keyed on its mid
+        self.pending = collections.OrderedDict()
+        self.next_report = time.time() + LATENCY_REPORT_INTERVAL
+        self.lock = threading.Lock()
+
+    def finish(self, mqttc, trace):
+        """Record a bridged event now, or once paho has sent its last publish."""
+        with self.lock:
+            info = trace.info
+            if info is None or info.is_published():
+                self._record(trace, time.time())
+            else:
+                self.pending[info.mid] = trace
+                if len(self.pending) > LATENCY_PENDING_MAX:
+                    self.pending.popitem(last=False)
+        if time.time() >= self.next_report:
+            self.report(mqttc)
+
+    def acked(self, client, userdata, mid, *args):
+        """paho on_publish callback."""
+        with self.lock:
+            trace = self.pending.pop(mid, None)
+            if trace is not None:
+                self._record(trace, time.time())
+
+    def _record(self, trace, now):
+        stages = dict(trace.stages)
+        if trace.info is not None:
+            stages["ack"] = now - trace.last
+        stages["bridge"] = now - trace.ingested
+        if trace.decoded is not None:
+            stages["pipe"] = trace.ingested - trace.decoded
+            stages["total"] = now - trace.decoded
+        for scope in (self.receiver, trace.model):
+            histograms = self.histograms.setdefault(scope, {})
+            for stage, seconds in stages.items():
+                histogram = histograms.get(stage)
+                if histogram is None:
+                    histogram = histograms[stage] = LatencyHistogram()
+                histogram.add(seconds)
+
+    def report(self, mqttc):
+        """Log the receiver's latency per stage and publish all histograms."""
+        with self.lock:
+            self.next_report = time.time() + LATENCY_REPORT_INTERVAL
+            summaries = {scope: {stage: histogram.summary() for stage, histogram in histograms.items()}
+                         for scope, histograms in self.histograms.items()}
+        receiver = summaries.pop(self.receiver, {})
+        for stage, summary in sorted(receiver.items()):
+            logging.info(f"Latency {stage}: p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, "
+                         f"max {summary['max_ms']} ms over {summary['count']} events")
+        metrics = {
+            "bucket_ms": [1000 * bound for bound in LATENCY_BUCKETS],
+            "receiver": {"name": self.receiver, "stages": receiver},
+            "models": summaries,
+        }
+        publish(mqttc, LATENCY_TOPIC, dump_json(metrics), qos=0, retain=False)
+
+
+class DeferredLane:
+    """Latest pending payload per topic for a deferred publish lane.
+
+    A topic updated again before the flush keeps only its newest payload
+    and moves to the back; when the lane is full the topic that has waited
+    longest is dropped.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.pending = collections.OrderedDict()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def put(self, topic, payload):
+        with self.lock:
+            self.pending.pop(topic, None)
+            self.pending[topic] = payload
+            if len(self.pending) > self.limit:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+
+    def take(self):
+        """Return and clear the pending (topic, payload)s and the count dropped since the last take."""
+        with self.lock:
+            batch = list(self.pending.items())
+            dropped = self.dropped
+            self.pending.clear()
+            self.dropped = 0
+        return batch, dropped
+
+
+# Diagnostic field states waiting for the next flush
+diagnostics = DeferredLane(DIAGNOSTIC_LANE_SIZE)
+
+
+def flush_diagnostics(mqttc, on_change=None):
+    """Publish the diagnostic lane every DIAGNOSTIC_FLUSH_INTERVAL seconds."""
+    lane = PUBLISH_LANES["diagnostic"]
+    while True:
+        time.sleep(DIAGNOSTIC_FLUSH_INTERVAL)
+        batch, dropped = diagnostics.take()
+        if dropped:
+            logging.warning(f"Shed {dropped} diagnostic update(s) under load")
+        for topic, payload in batch:
+            publish(mqttc, topic, payload, qos=lane.qos, retain=lane.retain)
+        if batch and on_change is not None:
+            on_change()
+
+
+def publish(mqttc, topic, payload, qos=0, retain=False):
+    """Publish to MQTT, going through the offline spool when it is enabled."""
+    if spool is not None and spool.capture(mqttc, topic, payload, qos, retain):
+        return
+    if mqttc is mqtt_client and not mqtt_ready.is_set():
+        # Hold the pipeline rather than drop publishes paho can't send yet
+        logging.warning("Waiting for the MQTT broker before publishing")
+        mqtt_ready.wait()
+    if topic_aliases is not None and mqttc is mqtt_client:
+        info, saved = topic_aliases.publish(mqttc, topic, payload, qos, retain)
+        savings.add(aliases=saved)
+    else:
+        info = mqttc.publish(topic, payload, qos=qos, retain=retain)
+    trace = getattr(tracing, "event", None)
+    if trace is not None and mqttc is mqtt_client:
+        # Publishes leave paho in order, so the event's last one stands for all of them
+        trace.info = info
+
+
+class TimeSeriesSink:
+    """Batched writer of mapped values to a time-series database.
+
+    timeseries_url picks the protocol: influx:// and influx+https:// POST
+    InfluxDB line protocol to the URL's path, influx+udp:// sends it in
+    datagrams, and graphite:// writes the plaintext protocol over TCP.
+    Events only append to a bounded buffer, which drops its oldest lines
+    when full; a background thread writes up to TIMESERIES_BATCH_SIZE
+    lines as soon as that many are waiting, or every flush interval, over
+    one connection kept open between writes.
+    """
+
+    def __init__(self, url, token, flush_interval):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in TIMESERIES_SCHEMES or not parts.hostname:
+            raise ValueError(f"timeseries_url must look like <{'|'.join(TIMESERIES_SCHEMES)}>://host:port/...")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or {"graphite": 2003, "influx+udp": 8089}.get(self.scheme, 8086)
+        self.path = urllib.parse.urlunsplit(("", "", parts.path or "/write", parts.query, ""))
+        self.headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if token:
+            self.headers["Authorization"] = f"Token {token}"
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque(maxlen=TIMESERIES_BUFFER_MAX)
+        self.dropped = 0
+        self.connection = None
+        self.ready = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def series(self, record):
+        """Return the line prefix for a device, kept on its record."""
+        if self.scheme == "graphite":
+            return ".".join([TIMESERIES_MEASUREMENT, record.model, sanitize(record.instance), sanitize(record.channel)])
+        tags = (("model", record.model), ("id", record.instance), ("channel", record.channel))
+        return TIMESERIES_MEASUREMENT + "".join(f",{tag}={value.translate(INFLUX_TAG_TABLE)}" for tag, value in tags)
+
+    def add(self, record, fields, now):
+        """Queue one event's numeric fields as (key, value) pairs."""
+        if record.series is None:
+            record.series = self.series(record)
+        if self.scheme == "graphite":
+            stamp = int(now)
+            lines = [f"{record.series}.{key} {value!r} {stamp}" for key, value in fields]
+        else:
+            # Always floats, so a field that is sometimes whole doesn't change type in InfluxDB
+            values = ",".join(f"{key}={value!r}" for key, value in fields)
+            lines = [f"{record.series} {values} {int(now * 1e9)}"]
+        with self.ready:
+            overflow = len(self.buffer) + len(lines) - TIMESERIES_BUFFER_MAX
+            if overflow > 0:
+                self.dropped += overflow
+            self.buffer.extend(lines)
+            if len(self.buffer) >= TIMESERIES_BATCH_SIZE:
+                self.ready.notify()
+
+    def _run(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: len(self.buffer) >= TIMESERIES_BATCH_SIZE, self.flush_interval)
+                batch = [self.buffer.popleft() for _ in range(min(len(self.buffer), TIMESERIES_BATCH_SIZE))]
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                logging.warning(f"Time-series buffer full, dropped {dropped} oldest line(s)")
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except (OSError, http.client.HTTPException) as e:
+                logging.warning(f"Time-series write to {self.host}:{self.port} failed, will retry: {e}")
+                self._close()
+                with self.ready:
+                    # Put the batch back in front of newer lines, as far as there is room;
+                    # what doesn't fit is its oldest end, reported with the next batch
+                    room = TIMESERIES_BUFFER_MAX - len(self.buffer)
+                    if room < len(batch):
+                        self.dropped += len(batch) - room
+                        batch = batch[len(batch) - room:]
+                    self.buffer.extendleft(reversed(batch))
+                time.sleep(self.flush_interval)
+
+    def _write(self, lines):
+        if self.scheme == "influx+udp":
+            if self.connection is None:
+                self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # One datagram per run of whole lines, each under TIMESERIES_UDP_MAX bytes where possible
+            chunk = []
+            size = 0
+            for line in lines:
+                line = line.encode() + b"\n"
+                if chunk and size + len(line) > TIMESERIES_UDP_MAX:
+                    self.connection.sendto(b"".join(chunk), (self.host, self.port))
+                    chunk = []
+                    size = 0
+                chunk.append(line)
+                size += len(line)
+            self.connection.sendto(b"".join(chunk), (self.host, self.port))
+            return
+
+        payload = ("\n".join(lines) + "\n").encode()
+        if self.scheme == "graphite":
+            if self.connection is None:
+                self.connection = socket.create_connection((self.host, self.port), TIMESERIES_TIMEOUT)
+            self.connection.sendall(payload)
+        else:
+            if self.connection is None:
+                connection_class = (http.client.HTTPSConnection if self.scheme == "influx+https"
+                                    else http.client.HTTPConnection)
+                self.connection = connection_class(self.host, self.port, timeout=TIMESERIES_TIMEOUT)
+            self.connection.request("POST", self.path, payload, self.headers)
+            response = self.connection.getresponse()
+            body = response.read()
+            if response.status >= 500:
+                raise http.client.HTTPException(f"HTTP {response.status}")
+            if response.status >= 300:
+                # The lines themselves were refused, so retrying them won't help
+                logging.error(f"Time-series write refused with HTTP {response.status}: {body[:200]!r}")
+
+    def _close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+            self.connection = None
+
+
+def start_timeseries():
+    """Return a TimeSeriesSink for timeseries_url, or None if it is off or unusable."""
+    if not TIMESERIES_URL:
+        return None
+    try:
+        return TimeSeriesSink(TIMESERIES_URL, TIMESERIES_TOKEN, TIMESERIES_FLUSH_INTERVAL)
+    except ValueError as e:
+        logging.error(f"Time-series output disabled: {e}")
+        return None
+
 
 def keep_alive():
     """Keep availability status alive by periodically publishing online status."""
     global mqtt_client
     while mqtt_client and mqtt_client.is_connected():
         try:
-            mqtt_client.publish(f"{MQTT_TOPIC}/status", payload="online", qos=0, retain=True)
+            mqtt_client.publish(STATUS_TOPIC, payload="online", qos=0, retain=True)
             logging.debug("Published keep-alive status")
             time.sleep(30)  # Publish every 30 seconds
         except:
             break
 
 
-def mqtt_connect(client, userdata, flags, rc):
+def mqtt_connect(client, userdata, flags, rc, properties=None):
     """Callback for MQTT connects."""
     global mqtt_client
     logging.info("MQTT connected: " + mqtt.connack_string(rc))
     
     # Publish online status immediately
-    client.publish(f"{MQTT_TOPIC}/status", payload="online", qos=0, retain=True)
+    client.publish(STATUS_TOPIC, payload="online", qos=0, retain=True)
     
     if rc != 0:
         logging.critical("Could not connect. Error: " + str(rc))
@@ -190,181 +1488,1708 @@ def mqtt_connect(client, userdata, flags, rc):
         keep_alive_thread = threading.Thread(target=keep_alive, daemon=True)
         keep_alive_thread.start()
 
+        # Aliases only live as long as the connection, and the broker sets how many
+        if topic_aliases is not None:
+            granted = topic_aliases.reset(getattr(properties, "TopicAliasMaximum", 0))
+            logging.info(f"Using {granted} MQTT topic aliases")
+
+        mqtt_ready.set()
+
+        # Replay anything spooled while the broker was unreachable
+        if spool is not None:
+            spool.start_drain(client)
+
+        # Without our old session the broker may have lost its retained configs too
+        if not flags.get("session present"):
+            discovery_hashes.clear()
 
-def mqtt_disconnect(client, userdata, rc):
+        # Shard workers hold the discovery state, so GC only runs single-process
+        if SHARD_WORKERS <= 1:
+            client.message_callback_add(GC_TOPIC, mqtt_gc_request)
+            client.subscribe(GC_TOPIC)
+            if SIGNAL_SUMMARY_INTERVAL > 0:
+                client.message_callback_add(SIGNAL_RAW_TOPIC, mqtt_signal_raw_request)
+                client.subscribe(SIGNAL_RAW_TOPIC)
+        client.message_callback_add(DIAGNOSTICS_TOPIC, mqtt_diagnostics_request)
+        client.subscribe(DIAGNOSTICS_TOPIC)
+
+
+def mqtt_disconnect(client, userdata, rc, properties=None):
     """Callback for MQTT disconnects."""
     logging.critical("MQTT disconnected: " + mqtt.connack_string(rc))
+    mqtt_ready.clear()
+    if topic_aliases is not None:
+        # The broker forgot them with the connection; don't hand out any until the next connect
+        topic_aliases.reset(0)
+    if spool is not None:
+        logging.warning(f"Spooling publishes to {SPOOL_DIR} until the broker is back")
+    # Jitter the backoff so clients don't all retry in step after a broker restart
+    client.reconnect_delay_set(min_delay=random.uniform(0.5, 1.5), max_delay=MQTT_RECONNECT_MAX)
 
 
-def sanitize(text):
-    """Sanitize a name for Graphite/MQTT use."""
-    return (text
-            .replace(" ", "_")
-            .replace("/", "_")
-            .replace(".", "_")
-            .replace("&", "")
-            .replace("-", "_"))
+def request_seconds(payload, default=0, longest=None):
+    """Return a request's payload as whole seconds, default if it is empty or 0, and at most longest.
 
+    Raises ValueError for anything but a non-negative integer.
+    """
+    seconds = int(payload or 0)
+    if seconds < 0:
+        raise ValueError(f"negative duration {seconds}")
+    seconds = seconds or default
+    if longest is not None and seconds > longest:
+        logging.warning(f"Limiting a {seconds}s request to {longest}s")
+        seconds = longest
+    return seconds
 
-def publish_config(mqttc, topic, model, instance, channel, mapping):
-    """Publish Home Assistant auto discovery data."""
-    global discovery_timeouts
 
-    device_type = mapping["device_type"]
-    object_id = "_".join([sanitize(model), str(instance)])
-    object_suffix = mapping["object_suffix"]
+def mqtt_gc_request(client, userdata, msg):
+    """Callback for discovery GC requests; the payload is an optional horizon in seconds."""
+    if msg.retain:
+        # A leftover request, not someone asking now
+        return
+    try:
+        horizon = request_seconds(msg.payload) or DISCOVERY_STALE_AFTER or GC_DEFAULT_HORIZON
+    except ValueError:
+        logging.warning(f"Ignoring discovery GC request with bad horizon {msg.payload!r}")
+        return
+    # Runs in its own thread so the network loop can deliver the retained configs
+    threading.Thread(target=collect_stale_discovery, args=(client, horizon), daemon=True).start()
 
-    path = "/".join([DISCOVERY_PREFIX, device_type, object_id, object_suffix, "config"])
 
-    # check timeout
-    now = time.time()
-    if path in discovery_timeouts:
-        if discovery_timeouts[path] > now:
-            return
+def mqtt_diagnostics_request(client, userdata, msg):
+    """Callback for diagnostics requests on .../diagnostics/profile or .../diagnostics/memory.
 
-    discovery_timeouts[path] = now + DISCOVERY_INTERVAL
+    The payload is an optional duration in seconds.
+    """
+    if msg.retain:
+        return
+    kind = msg.topic.rsplit("/", 1)[-1]
+    if kind not in DIAGNOSTICS:
+        logging.warning(f"Ignoring unknown diagnostic {kind!r}, expected one of {', '.join(DIAGNOSTICS)}")
+        return
+    try:
+        duration = request_seconds(msg.payload) or None
+    except ValueError:
+        logging.warning(f"Ignoring {kind} diagnostic request with bad duration {msg.payload!r}")
+        return
+    start_diagnostic(kind, duration)
 
-    config = mapping["config"].copy()
-    
-    # Use proper state topic format
-    config["state_topic"] = f"{MQTT_TOPIC}/{sanitize(model)}/{instance}/{channel}/{topic}"
-    config["name"] = f"{model} {instance} {mapping['config']['name']}"
-    config["unique_id"] = f"rtl433_{device_type}_{instance}_{object_suffix}"
-    
-    # CRITICAL FIX: Configure availability properly
-    config["availability_topic"] = f"{MQTT_TOPIC}/status"
-    config["payload_available"] = "online"
-    config["payload_not_available"] = "offline"
-    
-    # CRITICAL FIX: Handle expire_after properly
-    expire_after_val = int(EXPIRE_AFTER)
-    if expire_after_val > 0:
-        # Set expire_after to a reasonable value (not too short)
-        config["expire_after"] = max(expire_after_val, 300)  # Minimum 5 minutes
-        logging.debug(f"Set expire_after to {config['expire_after']} seconds")
-    else:
-        # Don't set expire_after if it's 0 or disabled
-        logging.debug("expire_after disabled")
 
-    # Add Home Assistant device info
-    if '-' in model:
-        manufacturer, model_name = model.split("-", 1)
-    else:
-        manufacturer = 'RTL433'
-        model_name = model
+def diagnostic_path(kind):
+    """Return a new file name in DIAGNOSTICS_DIR for a diagnostic's report."""
+    return os.path.join(DIAGNOSTICS_DIR, f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt")
 
-    device = {
-        "identifiers": [f"rtl433_{instance}"],
-        "name": f"{model} {instance}",
-        "model": model_name,
-        "manufacturer": manufacturer
-    }
-    config["device"] = device
 
-    mqttc.publish(path, json.dumps(config), qos=0, retain=True)
-    logging.debug(f"Published config to {path}")
+def profile_threads(duration):
+    """Sample the stacks of all threads for duration seconds; return the report's path.
 
+    The report has a line "thread;outermost;...;innermost count" per stack,
+    the collapsed format flamegraph.pl and speedscope read. Samples are
+    wall-clock, so threads waiting on stdin, the network or a sleep show
+    where they wait. Each sample costs a stack walk per thread.
+    """
+    me = threading.get_ident()
+    stacks = collections.Counter()
+    end = time.time() + duration
+    while time.time() < end:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(PROFILE_INTERVAL)
 
-def bridge_event_to_hass(mqttc, topic, data):
-    """Translate rtl_433 sensor data to Home Assistant auto discovery."""
+    path = diagnostic_path("profile")
+    with open(path, "w", encoding="utf-8") as handle:
+        for stack, count in stacks.most_common():
+            handle.write(f"{stack} {count}\n")
+    return path
 
-    if "model" not in data:
-        logging.debug("Ignoring non-device event")
+
+def trace_allocations(duration):
+    """Trace allocations for duration seconds; return the path of the report on what grew.
+
+    Only allocations made while tracing are seen, so what the report lists
+    is memory taken during the run and still held at its end, biggest first
+    with where it was allocated, followed by the biggest holders overall.
+    tracemalloc slows the bridge down and costs memory while it runs.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(MEMORY_FRAMES)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    growth = after.filter_traces(ignored).compare_to(before.filter_traces(ignored), "traceback")
+
+    path = diagnostic_path("memory")
+    with open(path, "w", encoding="utf-8") as handle:
+        handle.write(f"Growth over {duration}s, {sum(stat.size_diff for stat in growth)} bytes in total\n")
+        for stat in growth[:MEMORY_TOP]:
+            handle.write(f"\n{stat.size_diff:+} bytes in {stat.count_diff:+} blocks, now {stat.size} in {stat.count}\n")
+            handle.writelines(f"    {line}\n" for line in stat.traceback.format())
+        handle.write("\nBiggest by line\n")
+        for stat in after.filter_traces(ignored).statistics("lineno")[:MEMORY_TOP]:
+            handle.write(f"    {stat}\n")
+    return path
+
+
+# Diagnostic name -> (function, default duration, longest duration)
+DIAGNOSTICS = {
+    "profile": (profile_threads, PROFILE_DEFAULT, PROFILE_MAX),
+    "memory": (trace_allocations, MEMORY_DEFAULT, MEMORY_MAX),
+}
+diagnostics_running = set()
+diagnostics_lock = threading.Lock()
+
+
+def start_diagnostic(kind, duration=None):
+    """Run a diagnostic in the background, unless one of its kind is already running."""
+    function, default, longest = DIAGNOSTICS[kind]
+    duration = duration or default
+    if duration > longest:
+        logging.warning(f"Limiting the {kind} diagnostic to {longest}s")
+        duration = longest
+    with diagnostics_lock:
+        if kind in diagnostics_running:
+            logging.warning(f"A {kind} diagnostic is already running")
+            return
+        diagnostics_running.add(kind)
+
+    def run():
+        try:
+            logging.info(f"Running the {kind} diagnostic for {duration}s")
+            logging.info(f"Wrote the {kind} diagnostic to {function(duration)}")
+        except OSError as e:
+            logging.error(f"Cannot write the {kind} diagnostic to {DIAGNOSTICS_DIR}: {e}")
+        finally:
+            with diagnostics_lock:
+                diagnostics_running.discard(kind)
+
+    threading.Thread(target=run, name=f"rtl433_{kind}", daemon=True).start()
+
+
+def sanitize(text):
+    """Sanitize a name for Graphite/MQTT use."""
+    return text.translate(SANITIZE_TABLE)
+
+
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def model_forms(model):
+    """Return the derived forms of a raw rtl_433 model name, computed once per model."""
+    name = sys.intern(sanitize(model))
+    if '-' in name:
+        manufacturer, model_name = name.split("-", 1)
+    else:
+        manufacturer = 'RTL433'
+        model_name = name
+    return ModelForms(name, name, manufacturer, model_name, name, name)
+
+
+class Cadence:
+    """Streaming estimate of how often a device reports.
+
+    Keeps a smoothed mean and mean deviation of the gaps between reports,
+    updated the way TCP estimates round-trip times, so it costs two floats
+    per device and follows slow drift without storing any history.
+    """
+
+    __slots__ = ("last", "mean", "dev", "samples")
+
+    def __init__(self):
+        self.last = None
+        self.mean = None
+        self.dev = 0.0
+        self.samples = 0
+
+    def repeat_window(self):
+        """Return the gap below which an event is a repeat of the previous report."""
+        if self.mean is None:
+            return REPEAT_WINDOW
+        return min(REPEAT_WINDOW, self.mean / 4)
+
+    def observe(self, now):
+        """Record an event; return False if it is a repeat of the previous report."""
+        if self.last is not None:
+            gap = now - self.last
+            if gap < self.repeat_window():
+                return False
+            if self.mean is None:
+                self.mean = gap
+                self.dev = gap / 2
+            else:
+                error = gap - self.mean
+                self.mean += error / 8
+                self.dev += (abs(error) - self.dev) / 4
+            self.samples += 1
+        self.last = now
+        return True
+
+    def expire_after(self):
+        """Return the learned expire_after in seconds, or None while still learning.
+
+        Rounded up to quarter-octave steps so the discovery config only
+        changes when the cadence really moves.
+        """
+        if self.samples < CADENCE_MIN_SAMPLES:
+            return None
+        seconds = CADENCE_MISSED * (self.mean + 4 * self.dev)
+        seconds = min(max(seconds, EXPIRE_AFTER_MIN), EXPIRE_AFTER_MAX)
+        return int(math.ceil(2 ** (math.ceil(4 * math.log2(seconds)) / 4)))
+
+
+class DeviceRecord:
+    """Interned topic strings for one device, built on first sight and reused."""
+
+    __slots__ = ("model", "forms", "instance", "channel", "device", "base_topic",
+                 "object_id", "state_topics", "config_paths", "device_info",
+                 "overrides", "last_values", "device_path", "discovered",
+                 "cadence", "last_event", "availability_topic", "online", "deadline",
+                 "wheel_bucket", "fanout_topics", "windows", "signal", "series", "identity",
+                 "displaced_id", "last_seen")
+
+    def __init__(self, raw_model, raw_id, raw_channel):
+        self.forms = model_forms(raw_model)
+        self.model = self.forms.name
+        self.instance = sys.intern(str(raw_id)) if raw_id is not None else "0"
+        self.channel = sys.intern(str(raw_channel)) if raw_channel is not None else "A"
+        self.device = f"{raw_id}-{raw_model}"
+        self.base_topic = sys.intern(f"{MQTT_TOPIC}/{self.forms.topic_segment}/{self.instance}/{self.channel}")
+        self.state_topics = {}
+        self.config_paths = {}
+        self.device_info = None
+        self.overrides = store.device(self.model, self.instance)
+        self.last_values = {}
+        # Claimed by claim_identity once the device passes the id and whitelist checks
+        self.identity = self.object_id = self.device_path = self.displaced_id = None
+        self.discovered = set()
+        self.cadence = Cadence()
+        self.last_event = None
+        self.last_seen = None
+        self.availability_topic = sys.intern(f"{self.base_topic}/availability")
+        self.online = False
+        self.deadline = None
+        self.wheel_bucket = None
+        # Whole-event outputs this device feeds, as (topic, retain)
+        self.fanout_topics = tuple((topic, retain) for output, topic, retain in (
+            ("events", EVENTS_TOPIC, False),
+            ("states", STATES_TOPIC, True),
+            ("device", self.base_topic, True)) if output in fanout)
+        self.windows = {}
+        self.signal = None
+        self.series = None
+
+    def pinned_identity(self, mapping_store):
+        """Return the identity mappings_file pins this device to, or None."""
+        return mapping_store.identities.get(f"{self.model}/{self.instance}/{self.channel}")
+
+    def claim_identity(self):
+        """Resolve and claim this device's identity, if it hasn't got one yet."""
+        if self.identity is None:
+            self.set_identity(identities.identity(self.forms, self.instance, self.channel,
+                                                  self.pinned_identity(store)))
+
+    def set_identity(self, identity):
+        """Use identity for this device's unique_ids, identifiers and discovery topics."""
+        self.identity = identity
+        self.displaced_id = identities.displaced(self.forms, self.instance, self.channel, identity)
+        # A bare id keeps the config topics entities had before identities existed,
+        # also when the identity moves to a device with another id
+        prefix = f"{self.forms.object_prefix}_"
+        object_id = identity if identity.startswith(prefix) else f"{prefix}{identity}"
+        self.object_id = sys.intern(object_id)
+        self.device_path = sys.intern(f"{DISCOVERY_PREFIX}/device/{self.object_id}/config")
+        self.config_paths.clear()
+        self.device_info = None
+
+    def state_topic(self, key):
+        """Return the state topic for a mapped key."""
+        topic = self.state_topics.get(key)
+        if topic is None:
+            topic = self.state_topics[key] = sys.intern(f"{self.base_topic}/{key}")
+        return topic
+
+    def config_path(self, key, mapping):
+        """Return the discovery config topic for a mapped key."""
+        path = self.config_paths.get(key)
+        if path is None:
+            path = self.config_paths[key] = sys.intern("/".join(
+                [DISCOVERY_PREFIX, mapping["device_type"], self.object_id, mapping["object_suffix"], "config"]))
+        return path
+
+    def expire_after(self):
+        """Return the expire_after for this device's entities, or None for none."""
+        if LEARN_CADENCE == "true":
+            learned = self.cadence.expire_after()
+            if learned is not None:
+                return learned
+        expire_after_val = int(EXPIRE_AFTER)
+        if expire_after_val > 0:
+            # Set expire_after to a reasonable value (not too short)
+            return max(expire_after_val, 300)  # Minimum 5 minutes
+        return None
+
+    def liveness_timeout(self):
+        """Return how long this device may stay quiet before it is marked offline."""
+        if LEARN_CADENCE == "true":
+            learned = self.cadence.expire_after()
+            if learned is not None:
+                return learned
+        return DEVICE_TIMEOUT
+
+    def key_disabled(self, key):
+        """Return True if mappings_file turns this field off for this device."""
+        return key in self.overrides.get("disabled_keys", ())
+
+
+class TimingWheel:
+    """Device deadlines bucketed by tick, so a sweep only looks at what is due.
+
+    Rescheduling a device moves it between buckets in O(1). A deadline more
+    than one turn of the wheel away stays in its bucket until the turn in
+    which it falls due.
+    """
+
+    def __init__(self, tick, slots, now):
+        self.tick = tick
+        self.buckets = [set() for _ in range(slots)]
+        # Last tick whose bucket has been swept
+        self.cursor = int(now // tick) - 1
+        self.lock = threading.Lock()
+
+    def schedule(self, record, deadline):
+        """File a device under its new deadline."""
+        with self.lock:
+            if record.wheel_bucket is not None:
+                record.wheel_bucket.discard(record)
+            tick = max(int(deadline // self.tick), self.cursor + 1)
+            record.wheel_bucket = self.buckets[tick % len(self.buckets)]
+            record.wheel_bucket.add(record)
+            record.deadline = deadline
+
+    def cancel(self, record):
+        """Stop tracking a device."""
+        with self.lock:
+            if record.wheel_bucket is not None:
+                record.wheel_bucket.discard(record)
+                record.wheel_bucket = None
+
+    def expired(self, now):
+        """Return the devices whose deadline passed since the last sweep."""
+        due = []
+        with self.lock:
+            last = int(now // self.tick) - 1
+            # After a long stall one full turn visits every bucket
+            self.cursor = max(self.cursor, last - len(self.buckets))
+            while self.cursor < last:
+                self.cursor += 1
+                bucket = self.buckets[self.cursor % len(self.buckets)]
+                for record in [record for record in bucket if record.deadline <= now]:
+                    bucket.discard(record)
+                    record.wheel_bucket = None
+                    due.append(record)
+        return due
+
+
+liveness = TimingWheel(LIVENESS_TICK, LIVENESS_SLOTS, time.time())
+
+
+def mark_alive(mqttc, record, now):
+    """Push back a device's deadline, and announce it if it was offline."""
+    liveness.schedule(record, now + record.liveness_timeout())
+    if not record.online:
+        record.online = True
+        publish(mqttc, record.availability_topic, "online", qos=0, retain=True)
+
+
+def mark_known_offline(mqttc):
+    """Mark every device in the identity index offline until it reports again.
+
+    Availability is retained, so a device that never comes back after a
+    restart would otherwise stay online for good.
+    """
+    known = identities.devices()
+    for key in known:
+        publish(mqttc, f"{MQTT_TOPIC}/{key}/availability", "offline", qos=0, retain=True)
+    logging.info(f"Marked {len(known)} known device(s) offline until they report")
+
+
+def watch_liveness(mqttc, on_change=None):
+    """Mark devices offline once they stay quiet past their deadline."""
+    while True:
+        time.sleep(LIVENESS_TICK)
+        expired = liveness.expired(time.time())
+        for record in expired:
+            record.online = False
+            publish(mqttc, record.availability_topic, "offline", qos=0, retain=True)
+            logging.info(f"{record.model} {record.instance} went offline")
+        if expired and on_change is not None:
+            on_change()
+
+
+def lookup_device(data):
+    """Return the DeviceRecord for an event, creating it on first sight."""
+    key = (data["model"], data.get("id"), data.get("channel"))
+    record = device_table.get(key)
+    if record is None:
+        if len(device_table) >= DEVICE_TABLE_SIZE:
+            # Forget the least recently heard device; it is rebuilt if it shows up again
+            liveness.cancel(device_table.popitem(last=False)[1])
+        record = device_table[key] = DeviceRecord(*key)
+    else:
+        device_table.move_to_end(key)
+    return record
+
+
+def device_block(record, overrides):
+    """Return the Home Assistant device info for a device."""
+    return {
+        "identifiers": [f"rtl433_{record.identity}"],
+        "name": overrides.get("name", f"{record.model} {record.instance}"),
+        "model": record.forms.model_name,
+        "manufacturer": record.forms.manufacturer
+    }
+
+
+def build_config(record, topic, mapping, overrides, device):
+    """Return the discovery config for one mapped field of a device."""
+    device_type = mapping["device_type"]
+    object_suffix = mapping["object_suffix"]
+    model = record.model
+    instance = record.instance
+
+    config = mapping["config"].copy()
+    
+    # Use proper state topic format
+    config["state_topic"] = record.state_topic(topic)
+    config["name"] = f"{model} {instance} {mapping['config'].get('name', object_suffix)}"
+    config["unique_id"] = f"rtl433_{device_type}_{record.identity}_{object_suffix}"
+    
+    # CRITICAL FIX: Configure availability properly
+    if DEVICE_TIMEOUT > 0:
+        # Available only while both the bridge and the device itself are
+        config["availability"] = [{"topic": STATUS_TOPIC}, {"topic": record.availability_topic}]
+        config["availability_mode"] = "all"
+    else:
+        config["availability_topic"] = STATUS_TOPIC
+        config["payload_available"] = "online"
+        config["payload_not_available"] = "offline"
+    
+    # CRITICAL FIX: Handle expire_after properly
+    expire_after = record.expire_after()
+    if expire_after is not None:
+        config["expire_after"] = expire_after
+        logging.debug(f"Set expire_after to {config['expire_after']} seconds")
+    else:
+        # Don't set expire_after if it's 0 or disabled
+        logging.debug("expire_after disabled")
+
+    config["device"] = device
+
+    if mapping.get("attributes"):
+        config["json_attributes_topic"] = config["state_topic"]
+
+    # Per-field overrides from mappings_file (name, icon, units, ...)
+    for option, value in overrides.get("keys", NO_OVERRIDES).get(topic, NO_OVERRIDES).items():
+        if option == "aggregate":
+            if value.get("attributes"):
+                config["json_attributes_topic"] = f"{config['state_topic']}/attributes"
+        elif option != "deadband":
+            config[option] = value
+
+    return config
+
+
+def publish_config(mqttc, topic, record, mapping):
+    """Publish Home Assistant auto discovery data."""
+    global discovery_timeouts
+
+    path = record.config_path(topic, mapping)
+
+    # check timeout
+    now = time.time()
+    discovery_seen[path] = now
+    if path in discovery_timeouts:
+        if discovery_timeouts[path] > now:
+            return
+
+    discovery_timeouts[path] = now + DISCOVERY_INTERVAL
+    discovery_entries[path] = (topic, record)
+
+    # Add Home Assistant device info, built once per device
+    if record.device_info is None:
+        record.device_info = device_block(record, record.overrides)
+    config = build_config(record, topic, mapping, record.overrides, record.device_info)
+
+    clear_displaced_config(mqttc, record, mapping["device_type"], mapping["object_suffix"])
+    if send_config(mqttc, path, config):
+        logging.debug(f"Published config to {path}")
+
+
+def device_config(mapping_store, record):
+    """Return (path, config) for one device-based discovery message, or None if nothing is on.
+
+    Covers every mapped field seen from the device so far, as components
+    keyed by object_suffix, with the device block and availability sent once.
+    """
+    overrides = mapping_store.device(record.model, record.instance)
+    components = {}
+    for topic in sorted(record.discovered):
+        mapping = mapping_store.resolve(topic)
+        if mapping is None or topic in overrides.get("disabled_keys", ()):
+            continue
+        component = build_config(record, topic, mapping, overrides, None)
+        del component["device"]
+        shared = {option: component.pop(option) for option in SHARED_OPTIONS if option in component}
+        component["platform"] = mapping["device_type"]
+        components[mapping["object_suffix"]] = component
+    if not components:
+        return None
+
+    config = {
+        "device": device_block(record, overrides),
+        "origin": DISCOVERY_ORIGIN,
+        "components": components
+    }
+    config.update(shared)
+    return record.device_path, config
+
+
+def publish_device_config(mqttc, record, new_fields):
+    """Publish the device-based discovery message for a device.
+
+    Sent at most once per DISCOVERY_INTERVAL, or right away when the device
+    reports a field it hadn't before. Per-entity configs of new fields are
+    deleted first so Home Assistant doesn't see each entity twice after
+    switching discovery_mode.
+    """
+    path = record.device_path
+    now = time.time()
+    discovery_seen[path] = now
+    if not new_fields and discovery_timeouts.get(path, 0) > now:
+        return
+
+    discovery_timeouts[path] = now + DISCOVERY_INTERVAL
+    discovery_entries[path] = (None, record)
+
+    for topic in new_fields:
+        mapping = resolve_mapping(topic)
+        publish(mqttc, record.config_path(topic, mapping), "", qos=0, retain=True)
+        clear_displaced_config(mqttc, record, mapping["device_type"], mapping["object_suffix"])
+    clear_displaced_config(mqttc, record, "device")
+
+    entry = device_config(store, record)
+    if entry is not None and send_config(mqttc, *entry):
+        logging.debug(f"Published device config to {path}")
+
+
+def clear_displaced_config(mqttc, record, device_type, object_suffix=None):
+    """Delete a config the device had under its bare id before the id collided, once per run.
+
+    That retained config still carries the bare id's unique_id and
+    identifiers, so Home Assistant would keep merging the two devices.
+    """
+    if record.displaced_id is None:
         return
+    path = "/".join([DISCOVERY_PREFIX, device_type, record.displaced_id]
+                    + ([object_suffix] if object_suffix else []) + ["config"])
+    if path not in displaced_cleared:
+        displaced_cleared.add(path)
+        publish(mqttc, path, "", qos=0, retain=True)
+
+
+def send_config(mqttc, path, config):
+    """Publish a discovery config unless the broker already holds this exact one."""
+    payload = dump_json(config)
+    digest = hashlib.blake2b(payload.encode(), digest_size=16).digest()
+    if discovery_hashes.get(path) == digest:
+        return False
+    discovery_hashes[path] = digest
+    publish(mqttc, path, payload, qos=0, retain=True)
+    return True
+
+
+def remove_config(mqttc, path):
+    """Delete a retained discovery config, which removes the entity from Home Assistant."""
+    publish(mqttc, path, "", qos=0, retain=True)
+    discovery_entries.pop(path, None)
+    discovery_timeouts.pop(path, None)
+    discovery_hashes.pop(path, None)
+    discovery_seen.pop(path, None)
+
+
+def expire_stale_configs(mqttc, now):
+    """Remove the discovery configs of devices not seen for discovery_stale_after seconds."""
+    global next_stale_sweep
+    if DISCOVERY_STALE_AFTER <= 0 or now < next_stale_sweep:
+        return
+    next_stale_sweep = now + min(DISCOVERY_INTERVAL, DISCOVERY_STALE_AFTER)
+
+    stale = [path for path, seen in list(discovery_seen.items()) if now - seen > DISCOVERY_STALE_AFTER]
+    for path in stale:
+        remove_config(mqttc, path)
+    if stale:
+        logging.info(f"Removed {len(stale)} discovery config(s) unseen for {DISCOVERY_STALE_AFTER}s")
+
+
+def collect_stale_discovery(mqttc, horizon):
+    """Remove retained rtl_433 discovery configs on the broker unseen for horizon seconds.
+
+    Catches configs this run never published, e.g. from devices that vanished
+    before a restart. Only configs with an rtl433 unique_id and a state topic
+    under mqtt_topic are touched.
+    """
+    retained = {}
+
+    def on_config(client, userdata, msg):
+        if msg.retain and msg.payload:
+            retained[msg.topic] = msg.payload
+
+    # Entity configs, and device configs (<prefix>/device/<object_id>/config)
+    patterns = (f"{DISCOVERY_PREFIX}/+/+/+/config", f"{DISCOVERY_PREFIX}/+/+/config")
+    for pattern in patterns:
+        mqttc.message_callback_add(pattern, on_config)
+    mqttc.subscribe([(pattern, 0) for pattern in patterns])
+    time.sleep(GC_SCAN_SECONDS)
+    mqttc.unsubscribe(list(patterns))
+    for pattern in patterns:
+        mqttc.message_callback_remove(pattern)
+
+    now = time.time()
+    removed = 0
+    for path, payload in list(retained.items()):
+        try:
+            config = json.loads(payload)
+            # Device-based configs carry the ids and topics in their components
+            entities = [config] + list(config.get("components", {}).values())
+            owned = any(str(entity.get("unique_id", "")).startswith("rtl433")
+                        and str(entity.get("state_topic", "")).startswith(f"{MQTT_TOPIC}/")
+                        for entity in entities)
+        except (ValueError, AttributeError):
+            continue
+        # Configs not seen in this run count from when the bridge started, so a
+        # quiet device keeps its entities for a full horizon after a restart
+        if owned and now - discovery_seen.get(path, STARTED) > horizon:
+            remove_config(mqttc, path)
+            removed += 1
+
+    logging.info(f"Discovery GC scanned {len(retained)} retained config(s), removed {removed} stale")
+
+
+def config_for(mapping_store, record, topic):
+    """Return (path, config) for a field under the given store, or None if it is off."""
+    mapping = mapping_store.resolve(topic)
+    overrides = mapping_store.device(record.model, record.instance)
+    if mapping is None or topic in overrides.get("disabled_keys", ()):
+        return None
+    path = "/".join([DISCOVERY_PREFIX, mapping["device_type"], record.object_id, mapping["object_suffix"], "config"])
+    return path, build_config(record, topic, mapping, overrides, device_block(record, overrides))
+
+
+def republish_changed(mqttc, new_store):
+    """Republish only the discovery configs that a mappings_file change affects."""
+    for record in list(device_table.values()):
+        record.overrides = new_store.device(record.model, record.instance)
+        record.config_paths.clear()
+        record.device_info = None
+        pinned = record.pinned_identity(new_store)
+        if record.identity is not None and pinned is not None and pinned != record.identity:
+            record.set_identity(identities.identity(record.forms, record.instance, record.channel, pinned))
+
+    changed = removed = 0
+    for path, (topic, record) in list(discovery_entries.items()):
+        seen = discovery_seen.get(path)
+        if topic is None:
+            new = device_config(new_store, record)
+        else:
+            new = config_for(new_store, record, topic)
+        if new is None or new[0] != path:
+            # Field turned off or moved; drop the old entity from Home Assistant
+            remove_config(mqttc, path)
+            removed += 1
+        if new is not None:
+            discovery_entries[new[0]] = (topic, record)
+            discovery_timeouts[new[0]] = time.time() + DISCOVERY_INTERVAL
+            discovery_seen[new[0]] = seen or time.time()
+            if send_config(mqttc, *new):
+                changed += 1
+
+    logging.info(f"Mappings reload republished {changed} and removed {removed} discovery config(s)")
+
+
+def within_deadband(record, key, value, now):
+    """Return True if value is too close to the last one published to be worth sending.
+
+    A value is still sent once half the device's expire_after has passed, so
+    Home Assistant doesn't expire a sensor that is merely steady.
+    """
+    deadband = record.overrides.get("keys", NO_OVERRIDES).get(key, NO_OVERRIDES).get("deadband")
+    if deadband is None:
+        return False
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return False
+    last = record.last_values.get(key)
+    if last is not None and abs(value - last[0]) < deadband:
+        expire_after = record.expire_after()
+        if expire_after is None or now - last[1] < expire_after / 2:
+            return True
+    record.last_values[key] = (value, now)
+    return False
+
+
+class KeyWindow:
+    """Streaming aggregate of one device field over tumbling or sliding windows.
+
+    Without "slide", windows are aligned to multiples of "window" seconds,
+    keep a running count, sum, min and max, and are closed by the first
+    sample after their end. With "slide", the window covers the last
+    "window" seconds and is emitted at most every "slide" seconds; its
+    samples are kept with monotonic deques for min and max, so each sample
+    is added and dropped once. Either way a sample costs amortized O(1).
+    """
+
+    __slots__ = ("spec", "period", "slide", "samples", "lows", "highs",
+                 "count", "total", "low", "high", "last", "due")
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.period = spec["window"]
+        self.slide = spec.get("slide")
+        self.samples = collections.deque()
+        self.lows = collections.deque()
+        self.highs = collections.deque()
+        self.count = 0
+        self.total = 0.0
+        self.low = self.high = self.last = None
+        self.due = None
+
+    def add(self, now, value):
+        """Add a sample and return (value, min, max, count) if a window result is due."""
+        if self.slide is None:
+            return self._add_tumbling(now, value)
+        return self._add_sliding(now, value)
+
+    def _add_tumbling(self, now, value):
+        result = None
+        if self.count and now >= self.due:
+            result = self._result(self.low, self.high)
+            self.count = 0
+            self.total = 0.0
+        if not self.count:
+            self.due = (now // self.period + 1) * self.period
+            self.low = self.high = value
+        self.count += 1
+        self.total += value
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        self.last = value
+        return result
 
-    model = sanitize(data["model"])
+    def _add_sliding(self, now, value):
+        self.samples.append((now, value))
+        self.count += 1
+        self.total += value
+        self.last = value
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((now, value))
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((now, value))
+
+        start = now - self.period
+        while self.samples[0][0] <= start:
+            self.count -= 1
+            self.total -= self.samples.popleft()[1]
+        while self.lows[0][0] <= start:
+            self.lows.popleft()
+        while self.highs[0][0] <= start:
+            self.highs.popleft()
+
+        if self.due is not None and now < self.due:
+            return None
+        self.due = now + self.slide
+        return self._result(self.lows[0][1], self.highs[0][1])
+
+    def _result(self, low, high):
+        function = self.spec.get("function", "mean")
+        if function == "mean":
+            value = round(self.total / self.count, AGGREGATE_DIGITS)
+        elif function == "min":
+            value = low
+        elif function == "max":
+            value = high
+        else:
+            value = self.last
+        return value, low, high, self.count
+
+
+def publish_key_state(mqttc, record, key, value, now):
+    """Publish one field's state, or its window result if mappings_file aggregates it."""
+    state_topic = record.state_topic(key)
+    spec = record.overrides.get("keys", NO_OVERRIDES).get(key, NO_OVERRIDES).get("aggregate")
+    if spec is not None:
+        try:
+            sample = float(value)
+        except (TypeError, ValueError):
+            sample = None
+        if sample is not None:
+            window = record.windows.get(key)
+            if window is None or window.spec is not spec:
+                # First sample, or mappings_file changed the window
+                window = record.windows[key] = KeyWindow(spec)
+            result = window.add(now, sample)
+            if result is None:
+                return
+            value, low, high, count = result
+            if spec.get("attributes"):
+                attributes = {f"{key}_min": low, f"{key}_max": high, "samples": count}
+                publish(mqttc, f"{state_topic}/attributes", dump_json(attributes), qos=0, retain=True)
+
+    if within_deadband(record, key, value, now):
+        return
+    lane = PUBLISH_LANES[store.lane(key)]
+    if lane.deferred:
+        diagnostics.put(state_topic, format_value(value))
+        return
+    publish(mqttc, state_topic, format_value(value), qos=lane.qos, retain=lane.retain)
+    logging.debug(f"Published {key}={value} to {state_topic}")
+
+
+class SignalStats:
+    """Streaming signal statistics for one device or the whole receiver.
+
+    rssi, snr and noise each keep an EWMA that carries across summaries and
+    a histogram of SIGNAL_BUCKET_DB buckets that is reset by each summary.
+    Reports are counted separately from packets, so repeats of one
+    transmission don't hide loss. For a device, the gaps between reports
+    give its period; a gap of about n periods means n - 1 missed reports,
+    and such gaps are kept out of the period estimate.
+    """
+
+    __slots__ = ("ewma", "histograms", "packets", "reports", "missed", "period", "last_report")
+
+    def __init__(self):
+        self.ewma = {}
+        self.histograms = {}
+        self.packets = 0
+        self.reports = 0
+        self.missed = 0
+        self.period = None
+        self.last_report = None
+
+    def add(self, data, now, fresh, device=True):
+        """Add one packet's levels; fresh is False for a repeat of the previous report."""
+        self.packets += 1
+        if fresh:
+            self.reports += 1
+            if device and self.last_report is not None:
+                gap = now - self.last_report
+                if self.period is None or gap < 1.5 * self.period:
+                    self.period = gap if self.period is None else self.period + (gap - self.period) / 8
+                else:
+                    self.missed += round(gap / self.period) - 1
+            self.last_report = now
+        for key in SIGNAL_KEYS:
+            try:
+                value = float(data[key])
+            except (KeyError, TypeError, ValueError):
+                continue
+            last = self.ewma.get(key)
+            self.ewma[key] = value if last is None else last + SIGNAL_EWMA_ALPHA * (value - last)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {}
+            bucket = round(value / SIGNAL_BUCKET_DB)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def summary(self):
+        """Return the summary since the previous one and start a new interval."""
+        result = {"packets": self.packets, "reports": self.reports, "missed": self.missed,
+                  "loss": round(self.missed / (self.reports + self.missed), 3) if self.reports else None}
+        if self.period is not None:
+            result["period"] = round(self.period, 1)
+        for key, histogram in self.histograms.items():
+            buckets = sorted(histogram.items())
+            level = {"ewma": round(self.ewma[key], 2),
+                     "min": buckets[0][0] * SIGNAL_BUCKET_DB,
+                     "max": buckets[-1][0] * SIGNAL_BUCKET_DB}
+            total = sum(histogram.values())
+            for name, q in (("p10", 0.1), ("p50", 0.5), ("p90", 0.9)):
+                seen = 0
+                for bucket, count in buckets:
+                    seen += count
+                    if seen >= q * total:
+                        level[name] = bucket * SIGNAL_BUCKET_DB
+                        break
+            result[key] = level
+        self.histograms = {}
+        self.packets = self.reports = self.missed = 0
+        return result
+
+
+# Receiver-wide signal statistics, and until when raw levels are published per packet
+receiver_signal = SignalStats()
+raw_signal_until = 0
+
+
+def track_signal(mqttc, record, data, now, fresh):
+    """Feed an event's levels into the signal statistics and publish summaries when due."""
+    if record.signal is None:
+        record.signal = SignalStats()
+    record.signal.add(data, now, fresh)
+    receiver_signal.add(data, now, fresh, device=False)
+
+    if now < raw_signal_until:
+        for key in SIGNAL_KEYS:
+            if key in data:
+                publish(mqttc, record.state_topic(key), format_value(data[key]), qos=0, retain=False)
+
+    publish_signal_summaries(mqttc, now)
+
+
+def publish_signal_summaries(mqttc, now):
+    """Every signal_summary_interval, publish the summary of each device heard since the last one."""
+    global next_signal_summary
+    if now < next_signal_summary:
+        return
+    next_signal_summary = now + SIGNAL_SUMMARY_INTERVAL
+
+    mapping = resolve_mapping(SIGNAL_SUMMARY_KEY)
+    published = missed = 0
+    for record in list(device_table.values()):
+        if record.signal is None or not record.signal.packets:
+            continue
+        summary = record.signal.summary()
+        missed += summary["missed"]
+        publish(mqttc, record.state_topic(SIGNAL_SUMMARY_KEY), dump_json(summary), qos=0, retain=True)
+        published += 1
+        if auto_discovery and mapping is not None and not record.key_disabled(SIGNAL_SUMMARY_KEY):
+            if DISCOVERY_MODE != "device":
+                publish_config(mqttc, SIGNAL_SUMMARY_KEY, record, mapping)
+            elif SIGNAL_SUMMARY_KEY not in record.discovered:
+                record.discovered.add(SIGNAL_SUMMARY_KEY)
+                publish_device_config(mqttc, record, [SIGNAL_SUMMARY_KEY])
+
+    # Shard workers each see only some devices, so only a single process has the whole receiver
+    if SHARD_WORKERS <= 1:
+        receiver_signal.missed = missed
+        publish(mqttc, SIGNAL_TOPIC, dump_json(receiver_signal.summary()), qos=0, retain=True)
+    logging.debug(f"Published signal summaries for {published} device(s)")
+
+
+def mqtt_signal_raw_request(client, userdata, msg):
+    """Callback for raw level requests; the payload is an optional duration in seconds."""
+    global raw_signal_until
+    if msg.retain:
+        return
+    try:
+        duration = request_seconds(msg.payload, SIGNAL_RAW_DEFAULT, SIGNAL_RAW_MAX)
+    except ValueError:
+        logging.warning(f"Ignoring raw signal request with bad duration {msg.payload!r}")
+        return
+    raw_signal_until = time.time() + duration
+    logging.info(f"Publishing raw signal levels for {duration}s")
+
+
+class ProtocolAdvisor:
+    """Tally of decodes per rtl_433 protocol, to recommend a minimal -R list.
+
+    rtl_433 runs every enabled decoder on every block of samples, so
+    decoders that never decode anything here are pure CPU cost. Decodes are
+    counted per protocol, model and whitelist status, and per frequency
+    bucket for a frequency plan. The tally is saved with every report, so
+    it keeps growing across restarts.
+    """
+
+    def __init__(self, path, configured):
+        self.path = path
+        self.configured = configured
+        self.protocols = {}
+        self.since = time.time()
+        self.next_report = self.since + PROTOCOL_REPORT_INTERVAL
+        self.warned = False
+        try:
+            with open(path, encoding="utf-8") as handle:
+                saved = json.load(handle)
+            self.protocols = saved["protocols"]
+            self.since = saved["since"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Ignoring unreadable {path}: {e}")
+
+    def add(self, data, whitelisted):
+        """Count one decoded event."""
+        protocol = data.get("protocol")
+        if protocol is None:
+            return
+        tally = self.protocols.get(str(protocol))
+        if tally is None:
+            tally = self.protocols[str(protocol)] = {"decodes": 0, "whitelisted": 0, "models": {}, "freq": {}}
+        tally["decodes"] += 1
+        if whitelisted:
+            tally["whitelisted"] += 1
+        models = tally["models"]
+        models[data["model"]] = models.get(data["model"], 0) + 1
+        freq = data.get("freq")
+        if type(freq) in (int, float):
+            bucket = f"{round(freq / PROTOCOL_FREQ_BUCKET) * PROTOCOL_FREQ_BUCKET:.2f}"
+            tally["freq"][bucket] = tally["freq"].get(bucket, 0) + 1
+
+    def recommended(self):
+        """Return the protocols worth keeping: enough decodes, of whitelisted devices if the whitelist is on."""
+        count = "whitelisted" if whitelist_on else "decodes"
+        return sorted(int(protocol) for protocol, tally in self.protocols.items()
+                      if tally[count] >= PROTOCOL_MIN_DECODES)
+
+    def frequency_plan(self, keep):
+        """Return a frequency for each band the kept protocols were decoded in, busiest first.
+
+        Buckets within a MHz of each other form a band, centred on their
+        decode-weighted mean.
+        """
+        buckets = {}
+        for protocol in keep:
+            for bucket, count in self.protocols[str(protocol)]["freq"].items():
+                buckets[float(bucket)] = buckets.get(float(bucket), 0) + count
+        bands = []
+        for freq in sorted(buckets):
+            if bands and freq - bands[-1][-1] <= 1:
+                bands[-1].append(freq)
+            else:
+                bands.append([freq])
+        plan = [(sum(buckets[freq] for freq in band), sum(freq * buckets[freq] for freq in band)) for band in bands]
+        return [f"{weighted / decodes:.2f}M" for decodes, weighted in sorted(plan, reverse=True)]
+
+    def report(self):
+        """Return the current tally with its recommendations."""
+        keep = self.recommended()
+        return {
+            "since": datetime.fromtimestamp(self.since).isoformat(timespec="seconds"),
+            "decodes": sum(tally["decodes"] for tally in self.protocols.values()),
+            "protocols": self.protocols,
+            "configured": self.configured,
+            "unused": [protocol for protocol in self.configured if protocol not in keep],
+            "recommended": " ".join(f"-R {protocol}" for protocol in keep),
+            "frequencies": " ".join(f"-f {freq}" for freq in self.frequency_plan(keep)),
+        }
+
+    def publish_due(self, mqttc, now):
+        """Every protocol_report_interval, publish the report and save the tally."""
+        if now < self.next_report:
+            return
+        self.next_report = now + PROTOCOL_REPORT_INTERVAL
+        report = self.report()
+        publish(mqttc, PROTOCOL_TOPIC, dump_json(report), qos=0, retain=True)
+        logging.info(f"Protocols decoded: {report['recommended'] or 'none yet'}; "
+                     f"unused: {' '.join(map(str, report['unused'])) or 'none'}")
+        try:
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w", encoding="utf-8") as handle:
+                json.dump({"since": self.since, "protocols": self.protocols}, handle)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            if not self.warned:
+                logging.warning(f"Cannot keep the protocol tally in {self.path}: {e}")
+                self.warned = True
+
+
+def parse_frequency(text):
+    """Return an rtl_433 frequency argument such as 433.92M or 915000000 in MHz."""
+    scale = {"k": 1e-3, "M": 1, "G": 1e3}.get(text[-1:])
+    return float(text[:-1]) * scale if scale else float(text) / 1e6
+
+
+class HopScheduler:
+    """Hop plan for hop_frequencies, from the traffic heard on each band.
+
+    A device reporting every T seconds is heard at least once per visit to
+    its band if the band's dwell is longer than T, so each band dwells a bit
+    longer than the longest report period of the wanted devices on it
+    (whitelisted ones when the whitelist is on). Periods are only learned
+    from gaps shorter than the band's dwell, as a gap spanning the time on
+    other bands says nothing about the device. Bands without learned periods
+    get HOP_LEARN_DWELL if anything was decoded there, HOP_MIN_DWELL if not.
+
+    The plan is written to HOP_PLAN_FILE with what was learned, and entry.sh
+    starts each rtl_433 session with its -f/-H arguments.
+    """
+
+    def __init__(self, spec, path):
+        self.spec = spec
+        self.tokens = [token for token in spec.split() if token != "-f"]
+        self.frequencies = [parse_frequency(token) for token in self.tokens]
+        self.path = path
+        self.dwells = [HOP_LEARN_DWELL] * len(self.tokens)
+        self.decodes = [0] * len(self.tokens)
+        # "model/id/channel" -> [band, last heard, learned period]
+        self.devices = {}
+        self.next_plan = time.time() + HOP_PLAN_INTERVAL
+        self.warned = False
+        try:
+            with open(path, encoding="utf-8") as handle:
+                saved = json.load(handle)
+            # A plan for other frequencies has nothing to offer
+            if saved["frequencies"] == spec:
+                self.dwells = [band["dwell"] for band in saved["bands"]]
+                self.devices = saved["devices"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Ignoring unreadable {path}: {e}")
+
+    def band(self, freq):
+        """Return the index of the hop frequency a decode at freq MHz belongs to, or None."""
+        nearest = min(range(len(self.frequencies)), key=lambda band: abs(self.frequencies[band] - freq))
+        return nearest if abs(self.frequencies[nearest] - freq) <= HOP_BAND_WIDTH else None
+
+    def observe(self, key, data, now):
+        """Count a decode on its band, and learn the period of the device with key unless it is None."""
+        freq = data.get("freq")
+        if type(freq) not in (int, float):
+            return
+        band = self.band(freq)
+        if band is None:
+            return
+        self.decodes[band] += 1
+        if key is None:
+            return
+        device = self.devices.get(key)
+        if device is None:
+            device = self.devices[key] = [band, None, None]
+        last, period = device[1], device[2]
+        device[0], device[1] = band, now
+        if last is None:
+            return
+        gap = now - last
+        # Repeats of one transmission and gaps across visits to other bands aren't periods
+        if REPEAT_WINDOW < gap < self.dwells[band] and (period is None or gap < 1.5 * period):
+            device[2] = gap if period is None else period + (gap - period) / 8
+
+    def plan(self, now):
+        """Return the dwell of each band and describe it, forgetting devices long unheard."""
+        for key, (band, last, period) in list(self.devices.items()):
+            if last is None or now - last > HOP_FORGET_AFTER:
+                del self.devices[key]
+        bands = []
+        for band, token in enumerate(self.tokens):
+            periods = [period for on, last, period in self.devices.values() if on == band and period is not None]
+            if periods:
+                dwell = min(max(HOP_DWELL_MARGIN * max(periods), HOP_MIN_DWELL), HOP_MAX_DWELL)
+            elif self.decodes[band]:
+                dwell = HOP_LEARN_DWELL
+            else:
+                dwell = HOP_MIN_DWELL
+            bands.append({"frequency": token, "dwell": int(math.ceil(dwell)), "decodes": self.decodes[band],
+                          "devices": sum(1 for on, last, period in self.devices.values() if on == band),
+                          "longest_period": round(max(periods), 1) if periods else None})
+        return bands
+
+    def plan_due(self, mqttc, now):
+        """Every HOP_PLAN_INTERVAL, redo the plan, save it and publish it."""
+        if now < self.next_plan:
+            return
+        self.next_plan = now + HOP_PLAN_INTERVAL
+        bands = self.plan(now)
+        self.dwells = [band["dwell"] for band in bands]
+        self.decodes = [0] * len(self.tokens)
+        args = " ".join(f"-f {band['frequency']} -H {band['dwell']}" for band in bands)
+        publish(mqttc, HOP_TOPIC, dump_json({"args": args, "cycle": sum(self.dwells), "bands": bands}),
+                qos=0, retain=True)
+        logging.info(f"Hop plan: {args}")
+        try:
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w", encoding="utf-8") as handle:
+                json.dump({"frequencies": self.spec, "args": args, "bands": bands, "devices": self.devices}, handle)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            if not self.warned:
+                logging.warning(f"Cannot write the hop plan to {self.path}: {e}")
+                self.warned = True
+
+
+def is_repeat(record, data, now):
+    """Return True if an event is a repeated copy of the device's previous report."""
+    fresh = record.cadence.observe(now)
+    previous, record.last_event = record.last_event, data
+    if fresh or previous is None or len(previous) != len(data):
+        return False
+    return all(previous.get(key) == value for key, value in data.items() if key not in REPEAT_IGNORED_KEYS)
+
+
+def similar_reports(old, new):
+    """Return True if two reports look like the same sensor's.
+
+    Measurements both carry must be close, totals like rain are left out as
+    they restart with the batteries, and so must the RSSI. A report with
+    neither in common with the old one is not similar.
+    """
+    compared = 0
+    for key, value in new.items():
+        last = old.get(key)
+        if type(value) not in (int, float) or type(last) not in (int, float) or key in SIGNAL_KEYS:
+            continue
+        mapping = resolve_mapping(key)
+        if mapping is None or mapping["config"].get("state_class") != "measurement":
+            continue
+        if abs(value - last) > max(1.0, abs(last) * REASSOCIATE_TOLERANCE):
+            return False
+        compared += 1
+    try:
+        if abs(float(new["rssi"]) - float(old["rssi"])) > REASSOCIATE_RSSI_DB:
+            return False
+        compared += 1
+    except (KeyError, TypeError, ValueError):
+        pass
+    return compared > 0
+
+
+def reassociation_candidate(model, instance, channel, data, now):
+    """Return the vanished device a newly seen id most likely replaces, or None.
+
+    The vanished device has the same model and channel, went quiet within
+    reassociate_window seconds but long enough to have missed a report, and
+    its last report is similar. If several devices fit, none is picked.
+    """
+    candidates = []
+    for old in list(device_table.values()):
+        if old.instance == instance or old.model != model or old.channel != channel:
+            continue
+        period = old.cadence.mean
+        if old.last_seen is None or period is None or old.last_event is None:
+            continue
+        silence = now - old.last_seen
+        if REASSOCIATE_SILENCE * period <= silence <= REASSOCIATE_WINDOW and similar_reports(old.last_event, data):
+            candidates.append(old)
+    if len(candidates) > 1:
+        logging.info(f"{model} {instance} could replace any of "
+                     f"{', '.join(old.instance for old in candidates)}, not re-associating")
+        return None
+    return candidates[0] if candidates else None
+
+
+def stands_for_whitelisted(model, instance, channel, data, now):
+    """Return True if an id missing from the whitelist is a whitelisted device's new id.
+
+    Either it took over a whitelisted identity before, or a vanished device,
+    which got past the whitelist itself, is about to be re-associated with it.
+    """
+    if REASSOCIATE_WINDOW <= 0:
+        return False
+    if identities.get(f"{model}/{instance}/{channel}") in whitelist_list:
+        return True
+    return reassociation_candidate(model, instance, channel, data, now) is not None
+
+
+def reassociate(mqttc, record, old):
+    """Move a vanished device's identity, entities and history over to its new id.
+
+    The entities keep their unique_ids and config topics, so their configs
+    are only updated to the new state topics. The old id's retained states
+    are cleared and it is forgotten.
+    """
+    identities.transfer(old.forms, old.instance, record.instance, record.channel, old.identity)
+    record.set_identity(old.identity)
+    # Carry on the device's cadence from this report, not from its last one under the old id
+    old.cadence.last = record.cadence.last
+    record.cadence = old.cadence
+    record.signal = old.signal
+    record.last_values = old.last_values
+    record.windows = old.windows
+    record.discovered = old.discovered
+
+    liveness.cancel(old)
+    for key, other in list(device_table.items()):
+        if other is old:
+            del device_table[key]
+    for path, (topic, owner) in list(discovery_entries.items()):
+        if owner is old:
+            discovery_entries[path] = (topic, record)
+            discovery_timeouts.pop(path, None)
+    for topic in old.state_topics.values():
+        publish(mqttc, topic, "", qos=0, retain=True)
+    if "device" in fanout:
+        publish(mqttc, old.base_topic, "", qos=0, retain=True)
+    if DEVICE_TIMEOUT > 0:
+        publish(mqttc, old.availability_topic, "", qos=0, retain=True)
+    logging.info(f"{record.model} {old.instance} came back as {record.instance}, keeping identity {old.identity}")
+
+
+def bridge_event_to_hass(mqttc, topic, data):
+    """Translate rtl_433 sensor data to Home Assistant auto discovery."""
+
+    if "model" not in data:
+        logging.debug("Ignoring non-device event")
+        return
+
+    # Filtering only needs the id, so dropped events never get a DeviceRecord
+    model = model_forms(data["model"]).name
+    instance = str(data["id"]) if data.get("id") is not None else "0"
+    channel = str(data["channel"]) if data.get("channel") is not None else "A"
     logging.info(f"Processing device: {model}")
 
-    if "id" in data:
-        instance = str(data["id"])
-    else:
-        instance = "0"
+    # Every decode counts towards the protocol and band tallies, dropped or not
+    if advisor is not None:
+        advisor.add(data, instance in whitelist_list)
+        advisor.publish_due(mqttc, time.time())
+    if scheduler is not None:
+        wanted = instance != "0" and (not whitelist_on or instance in whitelist_list)
+        key = f"{model}/{instance}/{channel}" if wanted else None
+        scheduler.observe(key, data, time.time())
+        scheduler.plan_due(mqttc, time.time())
 
     if instance == "0":
         logging.warning(f"Device Id:{instance} doesn't appear to be a valid device. Skipping...")
         return
 
-    if "channel" in data:
-        channel = str(data["channel"])
-    else:
-        channel = 'A'
-
-    device = f'{data["id"]}-{data["model"]}'
-
-    if whitelist_on and (instance not in whitelist_list):
+    if (whitelist_on and instance not in whitelist_list
+            and not stands_for_whitelisted(model, instance, channel, data, time.time())):
         if instance not in blocked:
             logging.info(f"Device Id:{data['id']} Model: {data['model']} not in whitelist.")
-        blocked.append(str(data['id']))
+        blocked.add(instance)
         return
 
-    # Ensure we have a current online status
-    mqttc.publish(f"{MQTT_TOPIC}/status", payload="online", qos=0, retain=True)
+    record = lookup_device(data)
+    record.claim_identity()
+
+    now = time.time()
+    fresh = True
+    if LEARN_CADENCE == "true":
+        if is_repeat(record, data, now):
+            logging.debug(f"Dropped repeated report from {model} {instance}")
+            return
+    elif SIGNAL_SUMMARY_INTERVAL > 0 or REASSOCIATE_WINDOW > 0:
+        # Repeats are kept, but don't count as reports
+        fresh = record.cadence.observe(now)
+
+    if REASSOCIATE_WINDOW > 0:
+        if record.last_seen is None and f"{model}/{instance}/{record.channel}" in identities.new:
+            old = reassociation_candidate(model, instance, record.channel, data, now)
+            if old is not None:
+                reassociate(mqttc, record, old)
+        record.last_seen = now
+        record.last_event = data
+
+    trace = getattr(tracing, "event", None)
+    if trace is not None:
+        trace.model = model
+        trace.lap("dedup")
+
+    if DEVICE_TIMEOUT > 0:
+        mark_alive(mqttc, record, now)
+
+    # Alarm-lane fields go out before anything else the event publishes
+    publish_keys = "keys" in fanout
+    if publish_keys and PRIORITY_LANES == "true":
+        for key, value in data.items():
+            if store.lane(key) == "alarm" and not record.key_disabled(key):
+                publish_key_state(mqttc, record, key, value, now)
+
+    if SIGNAL_SUMMARY_INTERVAL > 0:
+        track_signal(mqttc, record, data, now, fresh)
+
+    # The retained status, keep-alive and will already cover availability
+    if "status" in fanout:
+        mqttc.publish(STATUS_TOPIC, payload="online", qos=0, retain=True)
+
+    # 1-3. Publish the whole event to the events, states and device topics,
+    # serialized once and shared by all of them
+    if record.fanout_topics:
+        payload = dump_json(data).encode()
+        for output_topic, retain in record.fanout_topics:
+            publish(mqttc, output_topic, payload, qos=0, retain=retain)
+
+    if auto_discovery:
+        expire_stale_configs(mqttc, now)
 
-    # Publish to multiple MQTT topics for compatibility
-    
-    # 1. Publish to rtl_433 events topic
-    events_topic = f"{MQTT_TOPIC}/events"
-    mqttc.publish(events_topic, json.dumps(data), qos=0, retain=False)
-    
-    # 2. Publish to rtl_433 states topic
-    states_topic = f"{MQTT_TOPIC}/states"
-    mqttc.publish(states_topic, json.dumps(data), qos=0, retain=True)
-    
-    # 3. Publish to device-specific topics
-    device_base_topic = f"{MQTT_TOPIC}/{sanitize(model)}/{instance}/{channel}"
-    mqttc.publish(device_base_topic, json.dumps(data), qos=0, retain=True)
-    
     # 4. Publish individual sensor values
+    new_fields = []
+    series = [] if timeseries is not None else None
     for key, value in data.items():
-        if key in mappings:
-            state_topic = f"{device_base_topic}/{key}"
-            mqttc.publish(state_topic, str(value), qos=0, retain=True)
-            logging.debug(f"Published {key}={value} to {state_topic}")
+        mapping = resolve_mapping(key)
+        if mapping is not None and not record.key_disabled(key):
+            if series is not None and type(value) in (int, float) and math.isfinite(value):
+                series.append((key, float(value)))
+            if publish_keys and store.lane(key) != "alarm":
+                publish_key_state(mqttc, record, key, value, now)
             
             # 5. Publish auto-discovery config if enabled
             if auto_discovery:
-                publish_config(mqttc, key, model, instance, channel, mappings[key])
+                if trace is not None:
+                    trace.lap("mapping")
+                if DISCOVERY_MODE != "device":
+                    publish_config(mqttc, key, record, mapping)
+                elif key not in record.discovered:
+                    record.discovered.add(key)
+                    new_fields.append(key)
+                if trace is not None:
+                    trace.lap("discovery")
+
+    if series:
+        timeseries.add(record, series, now)
+
+    if trace is not None:
+        trace.lap("mapping")
+    if auto_discovery and DISCOVERY_MODE == "device":
+        publish_device_config(mqttc, record, new_fields)
+        if trace is not None:
+            trace.lap("discovery")
 
     logging.info(f"Published complete data for {model} {instance}")
 
 
+def process_line(mqttc, line):
+    """Parse one line of rtl_433 output and bridge it to Home Assistant."""
+    trace = tracing.event = EventTrace(time.time()) if tracer is not None else None
+    try:
+        # Parse JSON from rtl_433
+        data = json.loads(line)
+        if trace is not None:
+            trace.lap("parse")
+            trace.decoded = decode_time(data.get("time")) if isinstance(data, dict) else None
+        bridge_event_to_hass(mqttc, "events", data)
+    except json.JSONDecodeError:
+        logging.debug(f"Non-JSON line: {line}")
+    except Exception as e:
+        logging.error(f"Error processing line: {e}")
+    tracing.event = None
+    # Only events that made it past the dedup stage are traced
+    if trace is not None and trace.model is not None:
+        tracer.finish(mqttc, trace)
+
+
+class ShardPublisher:
+    """Stand-in MQTT client for shard workers that collects publishes per event."""
+
+    def __init__(self):
+        self.pending = []
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.pending.append((topic, payload, qos, retain))
+
+
+def shard_of(line, shards):
+    """Pick the worker for a raw line, so each device always lands on the same one."""
+    model = SHARD_MODEL.search(line)
+    # Re-association looks for a device's new id among the same model's devices
+    instance = SHARD_ID.search(line) if REASSOCIATE_WINDOW <= 0 else None
+    key = (model.group(1) if model else b"") + b"\x1f" + (instance.group(1) if instance else b"")
+    return zlib.crc32(key) % shards
+
+
+def shard_worker(lines, results):
+    """Bridge the events of one slice of devices in a worker process."""
+    global spool, timeseries
+    # Publishing, spooling and the MQTT connection stay in the parent process
+    spool = None
+    publisher = ShardPublisher()
+    # Each worker writes the time series of its own devices
+    timeseries = start_timeseries()
+
+    def start_background(target):
+        # Background publishes get their own collector, flushed by the thread itself
+        background = ShardPublisher()
+
+        def forward():
+            results.put(background.pending)
+            background.pending = []
+
+        threading.Thread(target=target, args=(background, forward), daemon=True).start()
+
+    # Each worker reloads mappings_file and tracks liveness for its own slice of devices
+    start_background(watch_mappings_file)
+    if DEVICE_TIMEOUT > 0:
+        start_background(watch_liveness)
+    if PRIORITY_LANES == "true":
+        start_background(flush_diagnostics)
+
+    for line in iter(lines.get, None):
+        process_line(publisher, line)
+        if publisher.pending:
+            results.put(publisher.pending)
+            publisher.pending = []
+    results.put(None)
+
+
+def shard_publish(results, workers):
+    """Publish what the shard workers produce over the single MQTT connection."""
+    finished = 0
+    while finished < workers:
+        batch = results.get()
+        if batch is None:
+            finished += 1
+            continue
+        for topic, payload, qos, retain in batch:
+            if topic == STATUS_TOPIC:
+                mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+            else:
+                publish(mqtt_client, topic, payload, qos=qos, retain=retain)
+
+
+def start_shards(workers):
+    """Start the shard worker processes; must run before the MQTT loop starts."""
+    results = multiprocessing.Queue(SHARD_QUEUE_SIZE)
+    queues = []
+    processes = []
+    for index in range(workers):
+        lines = multiprocessing.Queue(SHARD_QUEUE_SIZE)
+        process = multiprocessing.Process(target=shard_worker, args=(lines, results),
+                                          name=f"rtl433_shard_{index}", daemon=True)
+        process.start()
+        queues.append(lines)
+        processes.append(process)
+    logging.info(f"Started {workers} shard workers")
+    return queues, processes, results
+
+
+def run_shards(shards):
+    """Feed rtl_433 output to the shard workers until it ends."""
+    queues, processes, results = shards
+    publisher = threading.Thread(target=shard_publish, args=(results, len(queues)), daemon=True)
+    publisher.start()
+
+    for line in sys.stdin.buffer:
+        line = line.strip()
+        if line:
+            if recorder is not None:
+                recorder.record(line, time.time())
+            queues[shard_of(line, len(queues))].put(line)
+
+    for lines in queues:
+        lines.put(None)
+    publisher.join()
+    for process in processes:
+        process.join()
+
+
 def rtl_433_bridge():
     """Run a MQTT Home Assistant auto discovery bridge for rtl_433."""
-    global mqtt_client
-    
-    mqtt_client = mqtt.Client(client_id="rtl433_bridge")
+    global mqtt_client, spool, recorder, topic_aliases, savings, tracer, timeseries, advisor, scheduler
+
+    if SPOOL_ENABLE == "true":
+        try:
+            spool = OfflineSpool(SPOOL_DIR, SPOOL_MAX_BYTES, SPOOL_DRAIN_RATE)
+            spool.adopt(BACKFILL_DIR)
+        except OSError as e:
+            logging.error(f"Offline spool disabled, cannot use {SPOOL_DIR}: {e}")
+
+    if FLIGHT_RECORDER_SIZE > 0:
+        try:
+            recorder = FlightRecorder(FLIGHT_RECORDER_FILE, FLIGHT_RECORDER_SIZE)
+        except OSError as e:
+            logging.error(f"Flight recorder disabled, cannot use {FLIGHT_RECORDER_FILE}: {e}")
+
+    # Diagnostics on demand, also without MQTT: kill -USR1 profiles, kill -USR2 traces allocations.
+    # Handlers run between the main thread's bytecodes, so they only hand off to a thread
+    for signum, kind in ((signal.SIGUSR1, "profile"), (signal.SIGUSR2, "memory")):
+        signal.signal(signum, lambda signum, frame, kind=kind: threading.Thread(
+            target=start_diagnostic, args=(kind,), daemon=True).start())
+
+    shards = start_shards(SHARD_WORKERS) if SHARD_WORKERS > 1 else None
+    if not shards:
+        timeseries = start_timeseries()
+
+    # A fixed client id with a persistent session lets the broker resume it after a reconnect
+    if MQTT_PROTOCOL == "5":
+        mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID, protocol=mqtt.MQTTv5)
+        if MQTT_TOPIC_ALIASES > 0:
+            topic_aliases = TopicAliases(MQTT_TOPIC_ALIASES)
+    else:
+        mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
+    if topic_aliases is not None or JSON_SEPARATORS is not None:
+        savings = TransportSavings()
     mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     mqtt_client.on_connect = mqtt_connect
     mqtt_client.on_disconnect = mqtt_disconnect
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=MQTT_RECONNECT_MAX)
+
+    if LATENCY_TRACE == "true":
+        if shards:
+            logging.warning("latency_trace is not supported with shard_workers, ignoring it")
+        else:
+            tracer = LatencyTracer(RTL_SDR_SERIAL_NUM or "rtl_433")
+            mqtt_client.on_publish = tracer.acked
+
+    if PROTOCOL_REPORT_INTERVAL > 0:
+        if shards:
+            logging.warning("protocol_report_interval is not supported with shard_workers, ignoring it")
+        else:
+            advisor = ProtocolAdvisor(PROTOCOL_STATS_FILE, [int(n) for n in re.findall(r"-R\s*(\d+)", PROTOCOL)])
+
+    if HOP_FREQUENCIES:
+        if shards:
+            logging.warning("hop_frequencies can't be planned with shard_workers, rtl_433 hops with equal dwells")
+        else:
+            try:
+                scheduler = HopScheduler(HOP_FREQUENCIES, HOP_PLAN_FILE)
+            except ValueError as e:
+                logging.error(f"Bad hop_frequencies {HOP_FREQUENCIES!r}: {e}")
 
     # Set will message to mark as offline when disconnected
-    mqtt_client.will_set(f"{MQTT_TOPIC}/status", payload="offline", qos=0, retain=True)
+    mqtt_client.will_set(STATUS_TOPIC, payload="offline", qos=0, retain=True)
     
     try:
-        mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
+        # Connect in the background so a broker that is down at startup is retried too
+        if MQTT_PROTOCOL == "5":
+            # MQTT 5 keeps the session through clean_start and an expiry instead
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = MQTT_SESSION_EXPIRY
+            mqtt_client.connect_async(MQTT_HOST, MQTT_PORT, 60, clean_start=False, properties=properties)
+        else:
+            mqtt_client.connect_async(MQTT_HOST, MQTT_PORT, 60)
         mqtt_client.loop_start()
         logging.info('MQTT Bridge Started with stable availability...')
         
+        # Before any event is read, also with shard_workers, so each device's "online" comes after it
+        if DEVICE_TIMEOUT > 0:
+            mark_known_offline(mqtt_client)
+        if not shards:
+            threading.Thread(target=watch_mappings_file, args=(mqtt_client,), daemon=True).start()
+            if DEVICE_TIMEOUT > 0:
+                threading.Thread(target=watch_liveness, args=(mqtt_client,), daemon=True).start()
+            if PRIORITY_LANES == "true":
+                threading.Thread(target=flush_diagnostics, args=(mqtt_client,), daemon=True).start()
+
         # Read from stdin (rtl_433 output)
-        for line in sys.stdin:
-            line = line.strip()
-            if line:
-                try:
-                    # Parse JSON from rtl_433
-                    data = json.loads(line)
-                    bridge_event_to_hass(mqtt_client, "events", data)
-                except json.JSONDecodeError:
-                    logging.debug(f"Non-JSON line: {line}")
-                except Exception as e:
-                    logging.error(f"Error processing line: {e}")
+        if shards:
+            run_shards(shards)
+        else:
+            # Raw bytes, as json.loads takes them and the flight recorder keeps them
+            for line in sys.stdin.buffer:
+                line = line.strip()
+                if line:
+                    if recorder is not None:
+                        recorder.record(line, time.time())
+                    process_line(mqtt_client, line)
                     
     except KeyboardInterrupt:
         logging.info("Shutting down...")
     except Exception as e:
         logging.error(f"Error in main loop: {e}")
     finally:
+        if shards:
+            for process in shards[1]:
+                if process.is_alive():
+                    process.terminate()
         if mqtt_client:
-            mqtt_client.publish(f"{MQTT_TOPIC}/status", payload="offline", qos=0, retain=True)
+            mqtt_client.publish(STATUS_TOPIC, payload="offline", qos=0, retain=True)
             mqtt_client.loop_stop()
             mqtt_client.disconnect()
 
@@ -18,11 +18,20 @@ WHITELIST="$(bashio::config 'whitelist')"
 AUTO_DISCOVERY="$(bashio::config 'auto_discovery')"
 DEBUG="$(bashio::config 'debug')"
 EXPIRE_AFTER="$(bashio::config 'expire_after')"
+MAPPINGS_FILE="$(bashio::config 'mappings_file')"
+IDENTITY_FILE="$(bashio::config 'identity_file')"
+DISCOVERY_STALE_AFTER="$(bashio::config 'discovery_stale_after')"
+DISCOVERY_MODE="$(bashio::config 'discovery_mode')"
+LEARN_CADENCE="$(bashio::config 'learn_cadence')"
+MQTT_CLIENT_ID="$(bashio::config 'mqtt_client_id')"
+MQTT_RECONNECT_MAX="$(bashio::config 'mqtt_reconnect_max')"
 
 # Exit immediately if a command exits with a non-zero status:
 set -e
 
 export LANG=C
+export MAPPINGS_FILE IDENTITY_FILE DISCOVERY_STALE_AFTER DISCOVERY_MODE LEARN_CADENCE
+export MQTT_CLIENT_ID MQTT_RECONNECT_MAX
 PATH="/usr/local/bin:/usr/local/sbin:/usr/bin:/usr/sbin:/bin:/sbin"
 export LD_LIBRARY_PATH=/usr/local/lib64
 
@@ -46,6 +55,12 @@ bashio::log.info "DISCOVERY_PREFIX =" $DISCOVERY_PREFIX
 bashio::log.info "DISCOVERY_INTERVAL =" $DISCOVERY_INTERVAL
 bashio::log.info "AUTO_DISCOVERY =" $AUTO_DISCOVERY
 bashio::log.info "DEBUG =" $DEBUG
+bashio::log.info "MAPPINGS_FILE =" $MAPPINGS_FILE
+bashio::log.info "IDENTITY_FILE =" $IDENTITY_FILE
+bashio::log.info "DISCOVERY_STALE_AFTER =" $DISCOVERY_STALE_AFTER
+bashio::log.info "DISCOVERY_MODE =" $DISCOVERY_MODE
+bashio::log.info "LEARN_CADENCE =" $LEARN_CADENCE
+bashio::log.info "MQTT Client Id =" $MQTT_CLIENT_ID
 bashio::log.blue "::::::::rtl_433 running output::::::::"
 
 # Check if device is found